@@ -0,0 +1,316 @@
+# Benchmark the terminal's commands on large generated trees, without a console.
+#
+# Builds trees of three shapes and runs each command against them through Terminal.execute, the way
+# a typed line would run, with the answers to any questions fed in from a script and the output
+# thrown away:
+#   wide   one folder holding every file and folder directly
+#   deep   chains of folders nested CHAIN_DEPTH levels deep, with a file on every level
+#   mixed  folders holding 10 folders and 10 files each, filled breadth first
+# For each shape and size it records the time taken to build and index the tree, and for each
+# command the number of runs, the commands per second, and the mean, median, 99th percentile and
+# slowest time. A command is run --repeat times, or for --budget seconds if that comes first, so
+# that listing a million files does not take all day.
+#
+# The results are written as JSON, together with the Python version and the git commit. Passing the
+# results of an earlier run with --compare prints how each 99th percentile changed since then.
+#
+# Usage: python benchmarks/bench_terminal.py [--shapes wide,deep,mixed] [--sizes 1000,10000,100000,1000000]
+#        [--repeat 200] [--budget 5] [--logins 10] [--output bench_results.json] [--compare old.json]
+
+import argparse
+import builtins
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import File, Folder, LoginSystem, Terminal, path_of, redirect_output  # noqa: E402
+
+CHAIN_DEPTH = 200  # Levels in each chain of the deep tree
+FANOUT = 10  # Folders, and files, in each folder of the mixed tree
+
+
+def build_wide(top, total):
+    for n in range(total):
+        top.add_to_folder(Folder(f"item{n}") if n % 2 else File(f"item{n}", f"line {n}\n"))
+    return top, total
+
+
+def build_deep(top, total):
+    nodes = 0
+    work = None
+    chain = 0
+    while nodes < total:
+        folder = Folder(f"chain{chain}")
+        top.add_to_folder(folder)
+        nodes += 1
+        for level in range(CHAIN_DEPTH):
+            if nodes >= total:
+                break
+            folder.add_to_folder(File(f"file{level}", f"line {level}\n"))
+            inner = Folder(f"level{level}")
+            folder.add_to_folder(inner)
+            folder = inner
+            nodes += 2
+        if work is None:
+            work = folder.parent_directory  # The deepest folder of the first chain that has a file in it
+        chain += 1
+    return work, nodes
+
+
+def build_mixed(top, total):
+    nodes = 0
+    queue = deque([top])
+    while nodes < total:
+        folder = queue.popleft()
+        for i in range(FANOUT):
+            inner = Folder(f"dir{i}")
+            folder.add_to_folder(inner)
+            folder.add_to_folder(File(f"file{i}", f"line {i}\n"))
+            queue.append(inner)
+            nodes += 2
+    work = top.get("dir3") or top
+    work = work.get("dir4") or work
+    return work, nodes
+
+
+SHAPES = {'wide': build_wide, 'deep': build_deep, 'mixed': build_mixed}
+
+
+# Build a tree of one shape and return the terminal holding it, the folder the commands run in
+# and the number of nodes
+def build(shape, total, timings):
+    started = time.perf_counter()
+    root = Folder("root")
+    root.add_to_folder(Folder("recycle_bin"))
+    root.add_to_folder(Folder("bench_dest"))  # Where mv and cp put things
+    top = Folder(shape)
+    root.add_to_folder(top)
+    work, nodes = SHAPES[shape](top, total)
+    timings['build_seconds'] = round(time.perf_counter() - started, 3)
+    terminal = Terminal("bench", None)
+    started = time.perf_counter()
+    terminal.set_root(root)
+    timings['index_seconds'] = round(time.perf_counter() - started, 3)
+    terminal.current_directory = work
+    return terminal, work, nodes
+
+
+# Answer the questions the commands ask from a queue, instead of the console
+answers = deque()
+builtins.input = lambda prompt='': answers.popleft()
+
+
+def timed(terminal, line, *replies):
+    answers.extend(replies)
+    started = time.perf_counter()
+    terminal.execute(line)
+    elapsed = time.perf_counter() - started
+    answers.clear()
+    if terminal.failed:
+        raise RuntimeError(f"'{line}' failed: {terminal.last_error}")
+    return elapsed
+
+
+def first(folder, kind):
+    return next((content for content in folder.contents if isinstance(content, kind)), None)
+
+
+# Each operation runs one or more commands for run number i and returns [(name, seconds), ...].
+# Whatever it changes is put back, untimed if no command does it, so every run sees the same tree.
+
+def op_mkdir(terminal, work, i):
+    seconds = timed(terminal, f"mkdir bench{i}")
+    terminal.delete_item(work, work.get(f"bench{i}"))
+    return [('mkdir', seconds)]
+
+
+def op_cd(terminal, work, i):
+    folder = first(work, Folder)
+    seconds = timed(terminal, f"cd {folder.name}")
+    return [('cd', seconds), ('cd ..', timed(terminal, "cd .."))]
+
+
+def op_ls(terminal, work, i):
+    return [('ls', timed(terminal, "ls"))]
+
+
+def op_tree(terminal, work, i):
+    return [('tree', timed(terminal, "tree"))]
+
+
+def op_cat(terminal, work, i):
+    file = first(work, File)
+    viewed = timed(terminal, f"cat {file.name} -v")
+    created = timed(terminal, f"cat bench{i}", "some text", "more text :q")
+    terminal.delete_item(work, work.get(f"bench{i}"))
+    return [('cat -v', viewed), ('cat create', created)]
+
+
+def op_rm_restore(terminal, work, i):
+    item = first(work, Folder) or first(work, File)
+    removed = timed(terminal, f"rm {item.name} -y")
+    terminal.current_directory = terminal.recycle_bin
+    restored = timed(terminal, f"restore {item.name}")
+    terminal.current_directory = work
+    return [('rm', removed), ('restore', restored)]
+
+
+def op_mv(terminal, work, i):
+    file = first(work, File)
+    there = timed(terminal, f"mv {file.name} /bench_dest")
+    terminal.current_directory = terminal.root_directory.get("bench_dest")
+    back = timed(terminal, f"mv {file.name} {path_of(work)}")
+    terminal.current_directory = work
+    return [('mv', there), ('mv', back)]
+
+
+def op_cp(terminal, work, i):
+    item = first(work, Folder) or first(work, File)
+    seconds = timed(terminal, f"cp {item.name} /bench_dest")
+    destination = terminal.root_directory.get("bench_dest")
+    terminal.delete_item(destination, destination.get(item.name))
+    return [('cp', seconds)]
+
+
+OPERATIONS = [op_mkdir, op_cd, op_ls, op_tree, op_cat, op_rm_restore, op_mv, op_cp]
+
+
+def summarize(times):
+    times = sorted(times)
+    total = sum(times)
+    return {
+        'runs': len(times),
+        'ops_per_second': round(len(times) / total, 1) if total else None,
+        'mean_ms': round(total * 1000 / len(times), 4),
+        'p50_ms': round(times[len(times) // 2] * 1000, 4),
+        'p99_ms': round(times[min(len(times) - 1, int(len(times) * 0.99))] * 1000, 4),
+        'max_ms': round(times[-1] * 1000, 4),
+    }
+
+
+def run_operations(terminal, work, repeat, budget):
+    results = {}
+    for operation in OPERATIONS:
+        times = {}
+        started = time.perf_counter()
+        for i in range(repeat):
+            for name, seconds in operation(terminal, work, i):
+                times.setdefault(name, []).append(seconds)
+            if time.perf_counter() - started > budget:
+                break
+        for name, values in times.items():
+            results[name] = summarize(values)
+    return results
+
+
+# Register and log in accounts in a scratch directory, since LoginSystem keeps users.json in the
+# current directory. Both are dominated by the deliberately slow password hash.
+def run_logins(count):
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            login_system = LoginSystem()
+            registered, logged_in = [], []
+            for i in range(count):
+                started = time.perf_counter()
+                if not login_system.register(f"bench{i}", "Bench123", "Bench123"):
+                    raise RuntimeError(f"could not register bench{i}")
+                registered.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                if not login_system.login(f"bench{i}", "Bench123"):
+                    raise RuntimeError(f"could not log in as bench{i}")
+                logged_in.append(time.perf_counter() - started)
+        finally:
+            os.chdir(directory)
+    return {'register': summarize(registered), 'login': summarize(logged_in)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(label, operations):
+    print(label)
+    for name, result in operations.items():
+        print(f"  {name:<12} {result['runs']:>6} runs {result['ops_per_second'] or 0:>12.1f}/s  "
+              f"p50 {result['p50_ms']:>10.4f} ms  p99 {result['p99_ms']:>10.4f} ms  max {result['max_ms']:>10.4f} ms")
+
+
+# Print how the 99th percentile of each command changed since an earlier run
+def compare(old, new, threshold=1.25):
+    earlier = {(run['shape'], run['nodes']): run['operations'] for run in old['runs']}
+    earlier[('logins', 0)] = old.get('logins', {})
+    current = [((run['shape'], run['nodes']), run['operations']) for run in new['runs']]
+    current.append((('logins', 0), new.get('logins', {})))
+    slower = 0
+    print(f"Compared with {old.get('commit') or 'an earlier run'}:")
+    for key, operations in current:
+        for name, result in operations.items():
+            before = earlier.get(key, {}).get(name)
+            if not before or not before['p99_ms']:
+                continue
+            ratio = result['p99_ms'] / before['p99_ms']
+            mark = "  SLOWER" if ratio > threshold else ""
+            slower += bool(mark)
+            print(f"  {key[0]:<6} {key[1]:>8} {name:<12} p99 {before['p99_ms']:>10.4f} -> {result['p99_ms']:>10.4f} ms ({ratio:5.2f}x){mark}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the terminal's commands on generated trees")
+    parser.add_argument('--shapes', default='wide,deep,mixed', help="comma separated: wide, deep, mixed")
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help="comma separated node counts")
+    parser.add_argument('--repeat', type=int, default=200, help="most runs of each command")
+    parser.add_argument('--budget', type=float, default=5, help="most seconds spent on each command")
+    parser.add_argument('--logins', type=int, default=10, help="accounts to register and log in, 0 to skip")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'repeat': args.repeat, 'budget': args.budget},
+        'runs': [],
+    }
+    with open(os.devnull, 'w') as devnull:
+        for shape in args.shapes.split(','):
+            for size in (int(size) for size in args.sizes.split(',')):
+                run = {'shape': shape}
+                with redirect_output(devnull):
+                    terminal, work, run['nodes'] = build(shape, size, run)
+                    run['operations'] = run_operations(terminal, work, args.repeat, args.budget)
+                    terminal.close()
+                report['runs'].append(run)
+                print_results(f"{shape}, {run['nodes']} nodes (built in {run['build_seconds']} s, "
+                              f"indexed in {run['index_seconds']} s)", run['operations'])
+        if args.logins:
+            with redirect_output(devnull):
+                report['logins'] = run_logins(args.logins)
+            print_results("login system", report['logins'])
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to '{args.output}'")
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(json.load(file), report):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
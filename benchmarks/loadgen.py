@@ -0,0 +1,97 @@
+# Load generator for the terminal server (python main.py --serve).
+#
+# Opens a number of idle connections that log in and then just sit there, and a number of active ones
+# that each log in and run a mix of commands as fast as the server answers them. All of them use the
+# same account, so they all share one tree. Prints the time taken, the commands per second and the
+# latency of single commands.
+#
+# The account has to exist before the server starts, since the server reads users.json once. Running
+# this with --register creates it in the current directory first.
+#
+# Usage: python benchmarks/loadgen.py --user NAME --password PASSWORD [--connections 50] [--idle 1000]
+#        [--commands 200] [--host 127.0.0.1] [--port 2323] [--register]
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+PROMPT_END = b'\x1b[0m: '  # Every prompt ends with a colour reset, a colon and a space
+
+
+async def log_in(host, port, user, password):
+    reader, writer = await asyncio.open_connection(host, port)
+    await reader.readuntil(b': ')
+    writer.write(f"{user}\n".encode())
+    await reader.readuntil(b': ')
+    writer.write(f"{password}\n".encode())
+    await reader.readuntil(PROMPT_END)
+    return reader, writer
+
+
+async def run_command(reader, writer, line):
+    writer.write(f"{line}\n".encode())
+    return await reader.readuntil(PROMPT_END)
+
+
+async def active_client(number, args, latencies):
+    reader, writer = await log_in(args.host, args.port, args.user, args.password)
+    folder = f"loadgen{number}"
+    await run_command(reader, writer, f"mkdir {folder}")
+    await run_command(reader, writer, f"cd {folder}")
+    commands = [f"mkdir d{i}" if i % 4 == 0 else ("ls" if i % 4 == 1 else ("du" if i % 4 == 2 else "count"))
+                for i in range(args.commands)]
+    for line in commands:
+        start = time.perf_counter()
+        await run_command(reader, writer, line)
+        latencies.append(time.perf_counter() - start)
+    await run_command(reader, writer, "cd ..")
+    await run_command(reader, writer, f"rm {folder} -y")
+    writer.write(b"logout\n")
+    await writer.drain()
+    writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load generator for the terminal server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2323)
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--connections', type=int, default=50, help="connections running commands")
+    parser.add_argument('--idle', type=int, default=1000, help="connections that log in and wait")
+    parser.add_argument('--commands', type=int, default=200, help="commands run by each active connection")
+    parser.add_argument('--register', action='store_true', help="create the account in ./users.json and exit")
+    args = parser.parse_args()
+
+    if args.register:
+        from main import LoginSystem
+        LoginSystem().register(args.user, args.password, args.password)
+        return
+
+    start = time.perf_counter()
+    idle = []
+    for i in range(0, args.idle, 100):  # Log in a hundred at a time, so the listen backlog is not overrun
+        idle += await asyncio.gather(*(log_in(args.host, args.port, args.user, args.password) for _ in range(min(100, args.idle - i))))
+    print(f"{len(idle)} idle connections logged in after {time.perf_counter() - start:.2f} s")
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(active_client(number, args, latencies) for number in range(args.connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{len(latencies)} commands on {args.connections} connections in {elapsed:.2f} s, {len(latencies) / elapsed:.0f} per second")
+    if latencies:
+        print(f"Latency: median {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+              f"99th percentile {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, "
+              f"slowest {latencies[-1] * 1000:.2f} ms")
+
+    for _, writer in idle:
+        writer.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+# Measure how many bytes each file or folder takes in memory.
+#
+# Builds a tree of about a million nodes (folders of 100 files each, 100 folders per parent) twice:
+# once with the File and Folder classes as they were before they used __slots__ and a single
+# name index, and once with the current ones, which is measured again with the TreeIndex that every
+# tree is kept with. Text is left empty so only the nodes themselves are counted.
+#
+# Usage: python benchmarks/memory.py [number of nodes]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import File, Folder, TreeIndex  # noqa: E402
+
+
+# The original classes: plain objects with a __dict__, and a list of contents
+class OldFile:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+
+class OldFolder:
+    def __init__(self, name):
+        self.name = name
+        self.contents = []
+        self.parent_directory = None
+
+    def add_to_folder(self, folder):
+        self.contents.append(folder)
+
+
+def build(file_class, folder_class, total):
+    root = folder_class("root")
+    nodes = 1
+    parent = None
+    while nodes < total:
+        if parent is None or len(parent.contents) >= 100:
+            parent = folder_class(f"folder{nodes}")
+            root.add_to_folder(parent)
+            nodes += 1
+        folder = folder_class(f"folder{nodes}")
+        parent.add_to_folder(folder)
+        nodes += 1
+        for i in range(min(100, total - nodes)):
+            folder.add_to_folder(file_class(f"file{i}", ""))
+            nodes += 1
+    return root, nodes
+
+
+def measure(label, build_tree):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tree = build_tree()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    nodes = tree[1]
+    print(f"{label:<32} {nodes:>9} nodes  {used / 2 ** 20:8.1f} MiB  {used / nodes:6.1f} bytes per node")
+    return tree
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    measure("before (dict objects, list)", lambda: build(OldFile, OldFolder, total))
+    measure("after (__slots__, name index)", lambda: build(File, Folder, total))
+
+    def build_indexed():
+        root, nodes = build(File, Folder, total)
+        index = TreeIndex()
+        index.add(root)
+        return (root, index), nodes
+    measure("after, with the tree index", build_indexed)
+
+
+if __name__ == "__main__":
+    main()
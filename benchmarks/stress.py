@@ -0,0 +1,117 @@
+# Hammer one tree from many threads at once and check that it is still consistent afterwards.
+#
+# Several sessions share one Terminal, the way connections to the server do. Writer threads create
+# folders and files, move them to the recycle bin, restore them, empty the bin and undo and redo
+# some of it, while reader threads list, view and measure the tree, and the recycle bin expires items
+# after a few milliseconds so expiry runs in the middle of all of it. At the end the tree is walked and compared with the
+# name index, the recycle bin bookkeeping and the file, folder and byte totals on every folder.
+#
+# Usage: python benchmarks/stress.py [seconds] [writer threads] [reader threads]
+
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import Folder, Terminal, TerminalSession, ThreadLocalStream, redirect_output  # noqa: E402
+
+
+def writer(terminal, number, stop, errors):
+    session = TerminalSession(terminal)
+    i = 0
+    try:
+        with redirect_output(io.StringIO()):
+            while not stop.is_set():
+                name = f"w{number}_{i % 20}"
+                session.execute(f"mkdir {name}")
+                with session.lock.write():  # There is no command that writes a file without the editor
+                    if session.current_directory.get(f"{name}.txt") is None:
+                        session.create_file(session.current_directory, f"{name}.txt", "x" * i)
+                session.execute(f"rm {name} -y")
+                session.execute(f"rm {name}.txt -y")
+                session.execute("cd recycle_bin")
+                session.execute(f"restore {name}")
+                if i % 50 == 49:
+                    session.execute("empty -y")
+                if i % 25 == 24:  # Take back the last few commands while the readers are using the tree
+                    session.execute("undo 3")
+                    session.execute("redo 2")
+                session.execute("cd ..")
+                i += 1
+    except Exception as error:
+        errors.append(f"writer {number}: {error!r}")
+
+
+def reader(terminal, number, stop, errors, counter):
+    session = TerminalSession(terminal)
+    commands = ["ls", "tree root", "du", "count", "cd recycle_bin", "ls", "du", "cd ..", "cat w0_0.txt -v"]
+    try:
+        with redirect_output(io.StringIO()):
+            while not stop.is_set():
+                for line in commands:
+                    session.execute(line)
+                counter[number] += len(commands)
+    except Exception as error:
+        errors.append(f"reader {number}: {error!r}")
+
+
+def check(terminal):
+    seen = {}
+    stack = [terminal.root_directory]
+    while stack:
+        item = stack.pop()
+        seen.setdefault(item.name, set()).add(item)
+        if isinstance(item, Folder):
+            stack.extend(item.contents)
+    indexed = {name: set(entry) if isinstance(entry, dict) else {entry} for name, entry in terminal.index.names.items()}
+    assert seen.keys() == indexed.keys(), "the index does not match the tree"
+    assert seen == indexed, "the index points at the wrong items"
+
+    def totals(folder):
+        files = folders = size = 0
+        for content in folder.contents:
+            if isinstance(content, Folder):
+                inner = totals(content)
+                files, folders, size = files + inner[0], folders + inner[1] + 1, size + inner[2]
+            else:
+                files, size = files + 1, size + content.size
+        assert (folder.file_count, folder.folder_count, folder.byte_size) == (files, folders, size), f"wrong totals on '{folder.name}'"
+        return files, folders, size
+    totals(terminal.root_directory)
+
+    for item in terminal.recycle_bin_contents:
+        assert terminal.recycle_bin.get(item.name) is item, f"'{item.name}' is recorded as deleted but is not in the recycle bin"
+    return sum(len(items) for items in seen.values())
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    terminal = Terminal("stress", None, recycle_bin_ttl=0.005)
+    stop = threading.Event()
+    errors = []
+    counter = [0] * readers
+    threads = [threading.Thread(target=writer, args=(terminal, number, stop, errors)) for number in range(writers)]
+    threads += [threading.Thread(target=reader, args=(terminal, number, stop, errors, counter)) for number in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    terminal.close()
+    for error in errors:
+        print(error)
+    nodes = check(terminal)
+    print(f"{writers} writers and {readers} readers for {seconds} s: {sum(counter)} reads, "
+          f"{nodes} nodes at the end, {'no errors' if not errors else f'{len(errors)} errors'}, tree consistent")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
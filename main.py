@@ -1,72 +1,547 @@
 
 import os
-import msvcrt
+try:
+    import msvcrt
+except ImportError:  # msvcrt only exists on Windows
+    msvcrt = None
+try:
+    import termios
+    import tty
+except ImportError:  # termios only exists on Unix
+    termios = None
 import json
+import re
+import difflib
+import fnmatch
+import codecs
 import hashlib
 import secrets
 import getpass
 import sys
 import socket
-import difflib
 import threading
 import time
+import asyncio
+import argparse
+import io
+import contextlib
+import weakref
+import heapq
+import bisect
+import itertools
+import mmap
+import struct
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Return the size of a string in bytes once it is encoded as UTF-8
+def byte_length(text):
+    return len(text) if text.isascii() else len(text.encode())
+
+
+class TextBuffer:
+    # Builds everything typed or pasted into the editor out of many small appends. They are collected
+    # in a pending list and joined into one piece every PIECE_SIZE characters, so adding a line never
+    # copies the text typed before it and there is not a piece per line. Only the editor uses it: a
+    # file's text stays one string, shared through blob_store and kept between edits as deltas in its
+    # VersionHistory, and is read from a snapshot a piece at a time by File.chunks.
+    PIECE_SIZE = 65536
+    __slots__ = ('pieces', 'pending', 'pending_length')
+
+    def __init__(self, text=''):
+        self.pieces = []  # Joined strings, in order
+        self.pending = []  # Appended strings that have not been joined into a piece yet
+        self.pending_length = 0
+        if text:
+            self.append(text)
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    # Yield the text in order, one piece at a time
+    def chunks(self):
+        yield from self.pieces
+        yield from self.pending
+
+    def append(self, text):
+        self.pending.append(text)
+        self.pending_length += len(text)
+        if self.pending_length >= self.PIECE_SIZE:
+            self.join_pending()
+
+    def join_pending(self):
+        if self.pending:
+            self.pieces.append(''.join(self.pending))
+            self.pending = []
+            self.pending_length = 0
+
 
 class Editor:
     def __init__(self):
-        self.text = ""
+        self.buffer = TextBuffer()  # The text typed so far
+
+    @property
+    def text(self):
+        return str(self.buffer)
 
     def open_editor(self):
         print("Editor is now open. Type ':q' to exit.")
+        self.read_lines()
+
+    # Open the editor on a file that already exists. Its text is put on the clipboard so it can be
+    # pasted in and edited.
+    def edit_existing(self, text):
+        import pyperclip
+        pyperclip.copy(text)
+        print("Editor is now open. Type ':q' to exit.")
+        print("Paste the contents of the file and edit it as needed.")
+        self.read_lines()
+
+    def read_lines(self):
         while True:
-            user_input = input()
+            user_input = read_line()
             if ":q" in user_input:
                 index = user_input.index(":q")
-                self.text += user_input[:index] + "\n"
+                self.buffer.append(user_input[:index] + "\n")
                 break
-            self.text += user_input + "\n"
+            self.buffer.append(user_input + "\n")
+
+class BlobStore:
+    # Keep a single copy of each distinct file text, keyed by the SHA-256 hash of its bytes.
+    # Files hold a reference to the shared text and its hash, so copying a file, or writing the same
+    # text into many files, never stores the text twice. Each text is counted by the files using it
+    # and is dropped when the last of them changes or is freed.
+    def __init__(self):
+        self.blobs = {}  # Maps each hash to [text, number of files using it, the hash]
+        self.lock = threading.RLock()  # Reentrant because File.__del__ can run while the lock is held
+
+    # Store text, or find the copy already stored. Returns the stored text, its hash and its size in bytes.
+    # The hash returned is the stored one, so files with the same text share a single bytes object too.
+    def acquire(self, text):
+        data = text.encode()
+        digest = hashlib.sha256(data).digest()
+        with self.lock:
+            blob = self.blobs.get(digest)
+            if blob is None:
+                blob = self.blobs[digest] = [text, 0, digest]
+            blob[1] += 1
+            return blob[0], blob[2], len(data)
+
+    # Add another user of text that is already stored
+    def share(self, digest):
+        with self.lock:
+            self.blobs[digest][1] += 1
+
+    def release(self, digest):
+        with self.lock:
+            blob = self.blobs.get(digest)
+            if blob is not None:
+                blob[1] -= 1
+                if blob[1] <= 0:
+                    del self.blobs[digest]
+
+
+blob_store = BlobStore()  # Shared by every file in the process
+
+# Describe new as the lines it shares with old and the text it adds. Each part is either a
+# (start, end) range of old's lines to keep, or a string of new text. Lines the two texts start and
+# end with are matched directly, so only the part that changed goes through difflib.
+def make_delta(old, new):
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    prefix = 0
+    limit = min(len(old_lines), len(new_lines))
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+    parts = []
+
+    def keep(start, end):
+        if parts and isinstance(parts[-1], tuple) and parts[-1][1] == start:
+            parts[-1] = (parts[-1][0], end)
+        elif start < end:
+            parts.append((start, end))
+
+    keep(0, prefix)
+    old_middle = old_lines[prefix:len(old_lines) - suffix]
+    new_middle = new_lines[prefix:len(new_lines) - suffix]
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_middle, new_middle).get_opcodes():
+        if tag == 'equal':
+            keep(prefix + i1, prefix + i2)
+        elif j1 < j2:
+            parts.append(''.join(new_middle[j1:j2]))
+    keep(len(old_lines) - suffix, len(old_lines))
+    return tuple(parts)
+
+
+def apply_delta(old, delta):
+    old_lines = old.splitlines(keepends=True)
+    return ''.join(''.join(old_lines[part[0]:part[1]]) if isinstance(part, tuple) else part for part in delta)
+
+
+class VersionHistory:
+    # The earlier texts of a file. Each version is kept as a delta against the one before it, so
+    # history costs about as much as the edits made. Every so often a version is kept in full (a
+    # keyframe) so that rebuilding any version only applies a bounded number of deltas. A keyframe
+    # is the same string object as the text it was made from, so it costs nothing while a file or
+    # blob_store still holds that text.
+    __slots__ = ('entries', 'first', 'delta_size')
+    MAX_DELTAS = 32  # Most deltas between two keyframes
+    LIMIT = 1000  # Most versions kept; the oldest are dropped a keyframe at a time
+
+    def __init__(self, text, saved_at=None):
+        # Each entry is (saved at, size in bytes, keyframe text or None, delta or None)
+        self.entries = [(saved_at, byte_length(text), text, None)]
+        self.first = 1  # The number of the oldest version kept
+        self.delta_size = 0  # Characters held in deltas since the last keyframe
+
+    @property
+    def current(self):
+        return self.first + len(self.entries) - 1
+
+    def copy(self):
+        history = VersionHistory.__new__(VersionHistory)
+        history.entries, history.first, history.delta_size = list(self.entries), self.first, self.delta_size
+        return history
+
+    # Record new, the text that follows old, the latest version
+    def add(self, old, new):
+        delta = make_delta(old, new)
+        size = sum(2 if isinstance(part, tuple) else len(part) for part in delta)
+        since_keyframe = next(i for i in range(len(self.entries) - 1, -1, -1) if self.entries[i][2] is not None)
+        if len(self.entries) - since_keyframe > self.MAX_DELTAS or self.delta_size + size > len(new):
+            self.entries.append((time.time(), byte_length(new), new, None))
+            self.delta_size = 0
+        else:
+            self.entries.append((time.time(), byte_length(new), None, delta))
+            self.delta_size += size
+        if len(self.entries) > self.LIMIT:
+            keyframe = next((i for i in range(1, len(self.entries)) if self.entries[i][2] is not None), None)
+            if keyframe is not None:
+                del self.entries[:keyframe]
+                self.first += keyframe
+
+    # The text of a version, rebuilt from the keyframe at or before it
+    def text(self, number):
+        index = number - self.first
+        start = index
+        while self.entries[start][2] is None:
+            start -= 1
+        text = self.entries[start][2]
+        for _, _, _, delta in self.entries[start + 1:index + 1]:
+            text = apply_delta(text, delta)
+        return text
+
+
+# The VersionHistory of each file that has been rewritten, by the id of the file. Few files ever are,
+# so this costs less than a slot on every file. Shared by every file in the process, like blob_store.
+file_versions = {}
+
 
 class File:
+    # Files and folders use __slots__ instead of a per-object __dict__, and their names are interned so
+    # that repeated names share one string. What only some files need is kept elsewhere: the offset of
+    # text still in a snapshot shares _text with the text itself, and version histories are kept in
+    # file_versions. A tree of a million nodes takes about 130 bytes a node, or 170 with its TreeIndex,
+    # against 152 for plain objects without an index (see benchmarks/memory.py).
+    __slots__ = ('name', '_text', 'blob', 'parent_directory', 'previous', 'next', 'source', 'size')
+
     # Initialize a new file with a name and some text
     def __init__(self, name, text):
-        self.name = name  # The name of the file
-        self.text = text  # The contents of the file
+        self.name = sys.intern(name)  # The name of the file
+        # The contents of the file, shared through blob_store, or where they start in source while
+        # they are still in a snapshot
+        self._text = None
+        self.blob = None  # The hash of the text in blob_store
+        self.parent_directory = None  # The folder that contains this file
+        self.previous = self.next = None  # The items before and after this file in its folder's listing
+        self.source = None  # The SnapshotReader holding this file's text, if it has not been read yet
+        self.size = 0  # The size of the text in bytes
+        if text is not None:
+            self._text, self.blob, self.size = blob_store.acquire(text)
+
+    # Make a new file with the same name and text. The text itself is shared, not copied.
+    def copy(self, on_load=None):
+        file = File(self.name, None)
+        file._text, file.blob, file.size, file.source = self._text, self.blob, self.size, self.source
+        if self.blob is not None:
+            blob_store.share(self.blob)
+        if self.versions is not None:
+            file.versions = self.versions.copy()
+        return file
+
+    def __del__(self):
+        if self.blob is not None:
+            blob_store.release(self.blob)
+        file_versions.pop(id(self), None)
+
+    # Let go of the text in memory, which from now on is read from source at offset
+    def keep_in(self, source, offset):
+        if self.blob is not None:
+            blob_store.release(self.blob)
+        self.blob = None
+        self.source, self.source_offset = source, offset
+
+    # Where the text starts in source, while it has not been read yet
+    @property
+    def source_offset(self):
+        return self._text if self.source is not None else 0
+
+    @source_offset.setter
+    def source_offset(self, offset):
+        self._text = offset
+
+    # The VersionHistory of the file's earlier texts, once it has been rewritten
+    @property
+    def versions(self):
+        return file_versions.get(id(self))
+
+    @versions.setter
+    def versions(self, versions):
+        if versions is None:
+            file_versions.pop(id(self), None)
+        else:
+            file_versions[id(self)] = versions
+
+    # The contents of the file. Text that lives in a snapshot is read from it each time it is needed.
+    @property
+    def text(self):
+        if self.source is not None:
+            return self.source.read_text(self)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if self.parent_directory is not None:
+            self.parent_directory.before_change()
+        old_blob = self.blob
+        self._text, self.blob, size = blob_store.acquire(text)
+        if old_blob is not None:
+            blob_store.release(old_blob)
+        self.source = None
+        if self.parent_directory is not None:
+            self.parent_directory.dirty = True  # The new text only exists in memory
+            self.parent_directory.update_totals(0, 0, size - self.size)
+        self.size = size
+
+    # Yield the text of the file in pieces, for the commands that only go through it. Text still in a
+    # snapshot is decoded from it a piece at a time instead of as one string.
+    def chunks(self):
+        if self.source is not None:
+            yield from self.source.text_chunks(self)
+        else:
+            yield self._text
 
 # Define a class to represent a folder
 class Folder:
+    __slots__ = ('name', '_index', 'first', 'last', 'parent_directory', 'previous', 'next', 'source', 'source_offset',
+                 'dirty', 'file_count', 'folder_count', 'byte_size', 'copies', '__weakref__')
+
     # Initialize a new folder with a name
     def __init__(self, name):
-        self.name = name  # The name of the folder
-        self.contents = []  # A list of files and folders inside this folder
+        self.name = sys.intern(name)  # The name of the folder
+        self._index = {}  # Maps the name of each file and folder inside this folder to the object itself
+        # The contents are listed in the order of a doubly linked list through their previous and next,
+        # so an item can be put back where it was, or renamed, without rebuilding the dictionary
+        self.first = self.last = None
         self.parent_directory = None
+        self.previous = self.next = None  # The items before and after this folder in its parent's listing
+        # Where this folder's contents still have to be read from, if they are not in memory yet:
+        # a SnapshotReader, or a LazyCopy for a copy of another folder
+        self.source = None
+        self.source_offset = 0  # Where this folder's record is in the snapshot
+        self.copies = None  # Copies of this folder that have not been filled in yet (a WeakSet)
+        self.dirty = False  # Whether this folder has changed since it was last read from or written to a snapshot
+        # Totals for everything inside this folder, at any depth, kept up to date as the tree changes
+        self.file_count = 0
+        self.folder_count = 0
+        self.byte_size = 0
+
+    # The files and folders inside this folder, in the order they are listed. A folder from a snapshot
+    # reads them the first time they are used.
+    @property
+    def contents(self):
+        if self.source is not None:
+            self.source.load_folder(self)
+        contents = []
+        item = self.first
+        while item is not None:
+            contents.append(item)
+            item = item.next
+        return contents
+
+    @property
+    def index(self):
+        if self.source is not None:
+            self.source.load_folder(self)
+        return self._index
+
+    # Whether this folder's contents are in memory
+    @property
+    def is_loaded(self):
+        return self.source is None
+
+    # Make a copy of this folder and everything in it. The copy starts out empty and is filled in from
+    # this folder the first time its contents are used, so copying costs O(1) however big the folder is.
+    # on_load is called with each folder of the copy once it has been filled in.
+    def copy(self, on_load=None):
+        folder = Folder(self.name)
+        folder.file_count, folder.folder_count, folder.byte_size = self.file_count, self.folder_count, self.byte_size
+        folder.source = LazyCopy(self, on_load)
+        if self.copies is None:
+            self.copies = weakref.WeakSet()
+        self.copies.add(folder)
+        return folder
+
+    # Called before this folder changes. Copies of this folder and of the folders above it that have
+    # not been filled in yet are filled in, so they keep the contents they have now. Filling in a copy
+    # higher up makes new unfilled copies below it, so the folders are visited from the top down.
+    def before_change(self):
+        folders = []
+        folder = self
+        while folder is not None:
+            folders.append(folder)
+            folder = folder.parent_directory
+        for folder in reversed(folders):
+            for copy in list(folder.copies or ()):
+                copy.index  # Using the contents of a copy fills it in
 
-    # Add a file or folder to the current folder
+    # Put item into the listing after previous, or first if previous is None
+    def link(self, item, previous):
+        following = self.first if previous is None else previous.next
+        item.previous, item.next = previous, following
+        if previous is None:
+            self.first = item
+        else:
+            previous.next = item
+        if following is None:
+            self.last = item
+        else:
+            following.previous = item
+
+    # Take item out of the listing
+    def unlink(self, item):
+        if item.previous is None:
+            self.first = item.next
+        else:
+            item.previous.next = item.next
+        if item.next is None:
+            self.last = item.previous
+        else:
+            item.next.previous = item.previous
+        item.previous = item.next = None
+
+    # Add a file or folder to the end of the current folder. Its name must not be taken already.
     def add_to_folder(self, folder):
-        self.contents.append(folder)  # Append the new file or folder to the list of contents
-
-    # Display the folder structure in a tree-like format
-    def display(self, indent=0, is_last=True):
-        connector = '└── ' if is_last else '├── '
-        print('  ' * indent + connector + self.name)
-        for i, content in enumerate(self.contents):
-            is_last_content = i == len(self.contents) - 1
-            if isinstance(content, Folder):
-                content.display(indent + 1, is_last_content)
+        if folder.name in self.index:
+            raise ValueError(f"'{self.name}' already holds something named '{folder.name}'")
+        self.before_change()
+        self.index[folder.name] = folder
+        self.link(folder, self.last)
+        folder.parent_directory = self
+        self.dirty = True
+        self.update_totals(*totals_of(folder))
+
+    # Move an item inside this folder so it comes right after previous, or first if previous is None
+    def move_after(self, item, previous):
+        self.before_change()
+        self.unlink(item)
+        self.link(item, previous)
+        self.dirty = True
+
+    # Add the given changes to the totals of this folder and every folder above it
+    def update_totals(self, files, folders, size):
+        folder = self
+        while folder is not None:
+            folder.file_count += files
+            folder.folder_count += folders
+            folder.byte_size += size
+            folder = folder.parent_directory
+
+    # Look up a file or folder inside this folder by name, or return None if there is none
+    def get(self, name):
+        return self.index.get(name)
+
+    # Remove a file or folder from the current folder. It no longer has a parent, so changes made to it
+    # while it is out of the tree, by undo, only reach the totals of the folders it holds.
+    def remove_from_folder(self, item):
+        self.before_change()
+        del self.index[item.name]
+        self.unlink(item)
+        item.parent_directory = None
+        self.dirty = True
+        files, folders, size = totals_of(item)
+        self.update_totals(-files, -folders, -size)
+
+    # Rename a file or folder inside the current folder without changing its position in the listing
+    def rename_item(self, item, new_name):
+        self.before_change()
+        del self.index[item.name]
+        item.name = sys.intern(new_name)
+        self._index[item.name] = item
+        self.dirty = True
+
+    # Remove everything from the current folder
+    def clear(self):
+        self.before_change()
+        if isinstance(self.source, LazyCopy):
+            self.source.original.copies.discard(self)
+        self.source = None
+        for item in self._index.values():
+            item.parent_directory = None
+        self._index = {}
+        self.first = self.last = None
+        self.dirty = True
+        self.update_totals(-self.file_count, -self.folder_count, -self.byte_size)
+
+    # Yield the lines of a drawing of this folder and everything in it. The tree is walked with a stack
+    # rather than by recursion, so any depth can be drawn, and lines are produced as they are needed.
+    # max_depth stops below that many levels, dirs_only leaves out files, and limit stops after that
+    # many lines. A folder whose contents are not all drawn shows how many files and folders it holds,
+    # which comes from its totals without walking it.
+    def render(self, max_depth=None, dirs_only=False, limit=None):
+        # One entry per folder being drawn: its contents still to come, last first, and the prefix of
+        # their lines. Keeping a list per level rather than an entry per node keeps the garbage
+        # collector from rescanning the tree over and over while a large folder is drawn.
+        levels = []
+        item, prefix, is_last = self, '', True
+        drawn = 0
+        while True:
+            if limit is not None and drawn >= limit:
+                yield f"... stopped after {limit} lines"
+                return
+            drawn += 1
+            connector = '└── ' if is_last else '├── '
+            if not isinstance(item, Folder):
+                yield prefix + connector + item.name + '.txt'
             else:
-                connector = '└── ' if is_last_content else '├── '
-                print('  ' * (indent + 1) + connector + content.name + '.txt')
+                hide_contents = max_depth is not None and len(levels) >= max_depth and (item.file_count or item.folder_count)
+                if hide_contents or (dirs_only and item.file_count):
+                    counts = f"{item.file_count} file{'' if item.file_count == 1 else 's'}"
+                    if hide_contents:
+                        counts += f", {item.folder_count} folder{'' if item.folder_count == 1 else 's'}"
+                    yield f"{prefix}{connector}{item.name} ({counts})"
+                else:
+                    yield prefix + connector + item.name
+                if not hide_contents:
+                    contents = [content for content in item.contents if not dirs_only or isinstance(content, Folder)]
+                    if contents:
+                        contents.reverse()
+                        levels.append((contents, prefix + ('    ' if is_last else '│   ')))
+            while levels and not levels[-1][0]:
+                levels.pop()
+            if not levels:
+                return
+            pending, prefix = levels[-1]
+            item = pending.pop()
+            is_last = not pending
 
-    # Count the number of files and folders in the folder structure
+    # Count the number of files and folders in the folder structure (including this folder)
     def count_files_and_folders(self):
-        files = 0  
-        folders = 1  
-        for content in self.contents:  
-            if isinstance(content, Folder):  
-                sub_files, sub_folders = content.count_files_and_folders()  
-                files += sub_files  
-                folders += sub_folders  
-            else:  
-                files += 1  
-        return files, folders  
+        return self.file_count, self.folder_count + 1
     
     def is_in_recycle_bin(self):
         current = self
@@ -77,18 +552,509 @@ class Folder:
         return False
 
 
+class LazyCopy:
+    # Where a copied folder gets its contents from until it has been filled in
+    __slots__ = ('original', 'on_load')
+    lock = threading.RLock()  # Readers running at the same time may both try to fill in the same copy
+
+    def __init__(self, original, on_load):
+        self.original = original  # The folder that was copied
+        self.on_load = on_load  # Called with the copy once it has been filled in
+
+    # Fill in a copy with copies of everything in the original. Files share their text with the
+    # original's files, and folders are themselves unfilled copies.
+    def load_folder(self, folder):
+        with self.lock:
+            if folder.source is not self:
+                return  # Another thread filled it in first
+            for item in self.original.contents:
+                copy = item.copy(self.on_load)
+                folder._index[copy.name] = copy
+                folder.link(copy, folder.last)
+                copy.parent_directory = folder
+            if self.original.copies is not None:
+                self.original.copies.discard(folder)
+            folder.source = None
+            if self.on_load is not None:
+                self.on_load(folder)
+
+
+# Return the (files, folders, bytes) that a file or folder adds to the totals of the folders above it
+def totals_of(item):
+    if isinstance(item, Folder):
+        return item.file_count, item.folder_count + 1, item.byte_size
+    return 1, 0, item.size
+
+
+# Work out the totals of every folder below root from scratch. This reads the whole tree, and marks
+# every folder as changed so that none of them is dropped from memory and loses its totals.
+def count_totals(root):
+    frames = [(root, iter(list(root.contents)))]
+    while frames:
+        folder, contents = frames[-1]
+        item = next(contents, None)
+        if item is None:
+            frames.pop()
+            folder.dirty = True
+            if frames:
+                files, folders, size = totals_of(folder)
+                parent = frames[-1][0]
+                parent.file_count += files
+                parent.folder_count += folders
+                parent.byte_size += size
+        elif isinstance(item, Folder):
+            frames.append((item, iter(list(item.contents))))
+        else:
+            folder.file_count += 1
+            folder.byte_size += item.size
+
+
+# Tell whether an argument of rm, mv, cp or restore is a glob pattern rather than a plain name
+def is_pattern(name):
+    return any(char in name for char in '*?[')
+
+
+# Join a folder path and a name into the full path of an item inside that folder
+def join_path(folder_path, name):
+    if folder_path == "/":
+        return "/" + name
+    return folder_path + "/" + name
+
+
+# Return the full path of a file or folder by following its parent links up to the root
+def path_of(item):
+    names = []
+    while item.parent_directory is not None:
+        names.append(item.name)
+        item = item.parent_directory
+    return "/" + "/".join(reversed(names))
+
+
+class TreeIndex:
+    # Keep track of every file and folder in the tree by name, so that finding something by name does
+    # not require walking the whole tree. Paths are not indexed: a path is found by looking up each
+    # name in it in the folder above, so moving or renaming a folder only changes the entry for the
+    # folder itself, however much is inside it.
+    def __init__(self):
+        self.names = {}  # Maps a name to the item with that name, or to a dict (used as an ordered set) of them if there are several
+        self.similar = NgramIndex()  # Every name in the tree, for finding the ones close to a misspelled name
+        self.lock = threading.Lock()  # Folders read in by several reading sessions at once add to the index together
+
+    def add_name(self, item, name):
+        entry = self.names.get(name)
+        if entry is None:
+            self.names[name] = item
+            self.similar.add(name)
+        elif isinstance(entry, dict):
+            entry[item] = None
+        elif entry is not item:
+            self.names[name] = {entry: None, item: None}
+
+    def remove_name(self, item, name):
+        entry = self.names.get(name)
+        if entry is item:
+            del self.names[name]
+            self.similar.remove(name)
+        elif isinstance(entry, dict):
+            entry.pop(item, None)
+            if len(entry) == 1:
+                self.names[name] = next(iter(entry))
+
+    # Add a file or folder and everything inside it
+    def add(self, item):
+        with self.lock:
+            stack = [item]
+            while stack:
+                item = stack.pop()
+                self.add_name(item, item.name)
+                if isinstance(item, Folder) and item.is_loaded:  # Unread folders are indexed when they are read
+                    stack.extend(item.contents)
+
+    # Remove a file or folder and everything inside it
+    def remove(self, item):
+        with self.lock:
+            stack = [item]
+            while stack:
+                item = stack.pop()
+                self.remove_name(item, item.name)
+                if isinstance(item, Folder) and item.is_loaded:  # Unread folders are indexed when they are read
+                    stack.extend(item.contents)
+
+    # Move the entry of an item that has been renamed from old_name. What is inside it is unchanged.
+    def rename(self, item, old_name):
+        with self.lock:
+            self.remove_name(item, old_name)
+            self.add_name(item, item.name)
+
+    # Return every item with the given name that lies inside folder
+    def lookup_name(self, name, folder):
+        with self.lock:
+            entry = self.names.get(name)
+            items = [] if entry is None else list(entry) if isinstance(entry, dict) else [entry]
+        found = []
+        for item in items:
+            parent = item.parent_directory
+            while parent is not None and parent is not folder:
+                parent = parent.parent_directory
+            if parent is not None:
+                found.append(item)
+        return found
+
+
+# Return strings that every match of a regular expression must contain, so that grep can rule out
+# files that lack any of them without scanning them. Only plain characters outside groups and
+# brackets count, and a pattern with a top-level '|' has none, so the answer is always safe.
+def required_literals(pattern):
+    literals = []
+    run = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if escaped and not escaped.isalnum():
+                literal = escaped  # Escaped punctuation such as \. stands for itself
+            i += 2
+        elif char == '|':
+            return []
+        elif char == '[':
+            i += 2 if pattern[i + 1:i + 2] == ']' else 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            i += 1
+        elif char == '(':
+            depth = 0
+            while i < len(pattern):
+                if pattern[i] == '\\':
+                    i += 1
+                elif pattern[i] == '(':
+                    depth += 1
+                elif pattern[i] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            i += 1
+        elif char in '?*':
+            i += 1  # Whatever came before can be left out, and has already been left out of run
+        elif char == '{':
+            i = pattern.find('}', i) + 1 or len(pattern)
+        elif char in '.^$)+':
+            i += 1
+        else:
+            literal = char
+            i += 1
+        if literal is not None and pattern[i:i + 1] not in ('?', '*', '{'):
+            run += literal
+            if pattern[i:i + 1] != '+':
+                continue
+        if run:
+            literals.append(run)
+        run = ''
+    if run:
+        literals.append(run)
+    return literals
+
+
+class TextEntry:
+    # An indexed text: the words and trigrams it is listed under, and the files in memory holding it
+    __slots__ = ('key', 'words', 'trigrams', 'files')
+
+    def __init__(self, key, words, trigrams):
+        self.key = key
+        self.words = words
+        self.trigrams = trigrams
+        self.files = []
+
+
+class TextIndex:
+    # A full-text index over the files that have been written, or that grep or search have gone through.
+    # Each indexed text is listed under every word in it, for search, and under every three-character
+    # sequence of its lower-cased text, for grep. A file can only contain a string if it has all of the
+    # string's trigrams, so grep only scans the files that have them.
+    # Texts are indexed under a key that stays the same while a file is dropped from memory and read
+    # back: where its text is in the snapshot, or the file itself while its text is only in memory.
+    # Dropping a folder from memory detaches its files from their entries, so they can be freed, and
+    # the files read in again later are attached to the same entries without reading their text.
+    # Moving, renaming, recycling or restoring a file changes neither its key nor its entry.
+    WORD = re.compile(r'\w+')
+
+    def __init__(self):
+        self.words = {}  # Maps each lower-cased word to the set of entries containing it
+        self.trigrams = {}  # Maps each lower-cased trigram to the set of entries containing it
+        self.entries = {}  # Maps the key of each indexed text to its TextEntry
+        self.files = {}  # Maps each file attached to an entry to that entry
+        self.complete = weakref.WeakSet()  # Folders whose every file, however deep, is attached to an entry
+        self.lock = threading.Lock()  # Folders read in by commands running side by side add files at the same time
+
+    @staticmethod
+    def trigrams_of(text):
+        return set(map(''.join, zip(text, text[1:], text[2:])))
+
+    @staticmethod
+    def key_of(file):
+        return (file.source, file.source_offset) if file.source is not None else file
+
+    # Index a file. Its text is only read if no text with the same key has been indexed.
+    def add(self, file):
+        key = self.key_of(file)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.attach(file, entry)
+                return
+        text = ''.join(file.chunks()).lower()
+        words = set(self.WORD.findall(text))
+        trigrams = self.trigrams_of(text)
+        with self.lock:
+            self.attach(file, self.entries.get(key) or self.list(TextEntry(key, words, trigrams)))
+
+    def attach(self, file, entry):
+        if self.files.get(file) is not entry:
+            self.detach(file)
+            self.files[file] = entry
+            entry.files.append(file)
+
+    def detach(self, file):
+        entry = self.files.pop(file, None)
+        if entry is not None:
+            entry.files.remove(file)
+        return entry
+
+    # Stop indexing a file that has been deleted or rewritten. Its entry goes too, unless other files hold the same text.
+    def remove(self, file):
+        with self.lock:
+            entry = self.detach(file)
+            if entry is not None and not entry.files:
+                self.unlist(entry)
+
+    # Index a file again after its text has changed
+    def update(self, file):
+        self.remove(file)
+        self.add(file)
+
+    def has(self, file):
+        return file in self.files
+
+    # Forget that folder and the folders above it are fully indexed, after something that may hold
+    # unread folders has been put into folder
+    def changed(self, folder):
+        with self.lock:
+            while folder is not None and folder in self.complete:
+                self.complete.discard(folder)
+                folder = folder.parent_directory
+
+    # Called before a folder's contents are dropped from memory. Its files are detached from their
+    # entries, which stay, and the folder and those above it are no longer fully indexed, so the next
+    # grep or search that goes through it reads it in again and attaches the new files.
+    def evicted(self, folder):
+        with self.lock:
+            for content in folder._index.values():
+                if isinstance(content, File):
+                    self.detach(content)
+        self.changed(folder)
+
+    def list(self, entry):
+        self.entries[entry.key] = entry
+        for word in entry.words:
+            self.words.setdefault(word, set()).add(entry)
+        for trigram in entry.trigrams:
+            self.trigrams.setdefault(trigram, set()).add(entry)
+        return entry
+
+    # Called once the tree reads from a new snapshot. Each file's entry is listed again under the
+    # file's new key, and each entry with no file in memory under move(key), or dropped if that is None.
+    def rekey(self, move):
+        with self.lock:
+            entries = list(self.entries.values())
+            self.words, self.trigrams, self.entries, self.files = {}, {}, {}, {}
+            for entry in entries:
+                if not entry.files:
+                    key = move(entry.key)
+                    if key is not None and key not in self.entries:
+                        self.list(TextEntry(key, entry.words, entry.trigrams))
+                for file in entry.files:
+                    key = self.key_of(file)
+                    self.attach(file, self.entries.get(key) or self.list(TextEntry(key, entry.words, entry.trigrams)))
+
+    def unlist(self, entry):
+        if self.entries.get(entry.key) is entry:
+            del self.entries[entry.key]
+        for table, keys in ((self.words, entry.words), (self.trigrams, entry.trigrams)):
+            for key in keys:
+                entries = table[key]
+                entries.discard(entry)
+                if not entries:
+                    del table[key]
+
+    # Stop indexing every file in memory inside item. Folders that have not been read are skipped.
+    def remove_tree(self, item):
+        for file in self.files_in(item):
+            self.remove(file)
+
+    # The files inside item. Folders that have not been read are skipped unless read is set.
+    @staticmethod
+    def files_in(item, read=False):
+        stack = [item]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, File):
+                yield item
+            elif read or item.is_loaded:
+                stack.extend(item.contents)
+
+    # Return the files in memory containing every one of the given words
+    def files_with_words(self, words):
+        with self.lock:
+            sets = sorted((self.words.get(word.lower(), set()) for word in words), key=len)
+            return [file for entry in (set.intersection(*sets) if sets else ()) for file in entry.files]
+
+    # Return the files in memory that might contain all of the given strings, or None if any file might
+    def candidates(self, literals):
+        trigrams = set()
+        for literal in literals:
+            trigrams |= self.trigrams_of(literal.lower())
+        if not trigrams:
+            return None
+        with self.lock:
+            sets = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams), key=len)
+            return [file for entry in set.intersection(*sets) for file in entry.files]
+
+
+class UserStore:
+    # Store users on disk as a snapshot file plus an append-only journal.
+    # Each registration appends one JSON line to the journal and fsyncs it, so saving a user costs
+    # the same however many users there are, and a crash can at worst lose a half-written last line.
+    # Every so often the journal is compacted into a new snapshot, which is written to a temporary
+    # file and renamed over the old one so the snapshot on disk is always complete.
+    def __init__(self, path='users.json', compact_every=1000):
+        self.path = path  # The snapshot file: one JSON user record per line
+        self.journal_path = path + '.journal'  # Registrations made since the last snapshot
+        self.compact_every = compact_every  # Number of journal records after which the journal is compacted
+        self.journal_records = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Read the snapshot and then the journal one line at a time, and return a dictionary
+        # mapping each hashed username to that user's record.
+        users = {}
+        legacy = False
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if 'users' in record:
+                        # The old format kept every user in a single {"users": [...]} document
+                        legacy = True
+                        for user in record['users']:
+                            users[user['username']] = user
+                    else:
+                        users[record['username']] = record
+        except FileNotFoundError:
+            pass
+        self.journal_records = self.replay_journal(users)
+        if legacy:
+            self.compact(users)  # Rewrite the file once in the line-per-user format
+        return users
+
+    def replay_journal(self, users):
+        # Apply the journal on top of the snapshot. A last line that was only partly written
+        # before a crash is cut off, so that new records are not appended onto it.
+        count = 0
+        good_length = 0
+        try:
+            with open(self.journal_path, 'rb+') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    users[record['username']] = record
+                    good_length += len(line)
+                    count += 1
+                f.truncate(good_length)
+        except FileNotFoundError:
+            pass
+        return count
+
+    def append(self, user, users):
+        # Durably record a new user. users is the full dictionary, used when the journal is compacted.
+        with self.lock:
+            with open(self.journal_path, 'ab') as f:
+                f.write(json.dumps(user).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_records += 1
+            if self.journal_records >= self.compact_every:
+                self.compact(users, locked=True)
+
+    def compact(self, users, locked=False):
+        # Write every user to a new snapshot, atomically replace the old one and empty the journal.
+        if not locked:
+            with self.lock:
+                return self.compact(users, locked=True)
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            for user in list(users.values()):
+                f.write(json.dumps(user).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        fsync_directory(self.path)
+        # Records already in the snapshot are harmless to replay, so a crash before this point is safe
+        with open(self.journal_path, 'wb') as f:
+            os.fsync(f.fileno())
+        self.journal_records = 0
+
+
+# Make a rename inside the folder containing path durable (this is not possible on Windows)
+def fsync_directory(path):
+    if os.name == 'nt':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class LoginSystem:
     def __init__(self):
         # Initialize the login system by loading existing users from a JSON file.
+        # Users are stored in a dictionary keyed by their hashed username.
+        self.store = UserStore('users.json')
         self.users = self.load_users()
+        self.verifier = None  # Pool of worker threads used to check passwords, created on first use
+        self.verifier_lock = threading.Lock()
+
+    def hash_username(self, username):
+        # Usernames are only ever stored as their SHA-256 hash.
+        return hashlib.sha256(username.encode()).hexdigest()
 
     def login(self, username, password):
         # Check if a user with the given username and password exists in the system.
-        for user in self.users:
-            if user['username'] == hashlib.sha256(username.encode()).hexdigest():
-                if user['password'] == self.hash_password(password, bytes.fromhex(user['salt'])):
-                    return True
-        return False
+        user = self.users.get(self.hash_username(username))
+        if user is None:
+            return False
+        return self.check_password(user, password)
+
+    def login_async(self, username, password):
+        # Check a login on the worker pool and return a Future that resolves to True or False.
+        # PBKDF2 releases the GIL while it runs, so many logins can be checked at the same time
+        # on different cores, and a slow login never holds up the caller or any other session.
+        with self.verifier_lock:
+            if self.verifier is None:
+                self.verifier = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="login")
+        return self.verifier.submit(self.login, username, password)
+
+    def check_password(self, user, password):
+        # Compare in constant time so the comparison does not leak how much of the hash matched.
+        return secrets.compare_digest(user['password'], self.hash_password(password, bytes.fromhex(user['salt'])))
 
     def register(self, username, password, confirm_password):
     # Register a new user with the given username and password.
@@ -112,19 +1078,20 @@ class LoginSystem:
             print("Password should have at least one number.")
             return False
 
-        for user in self.users:
-            if user['username'] == hashlib.sha256(username.encode()).hexdigest():
-                print("Username already exists. Please choose a different username.")
-                return False
+        hashed_username = self.hash_username(username)
+        if hashed_username in self.users:
+            print("Username already exists. Please choose a different username.")
+            return False
 
         salt = secrets.token_bytes(16).hex()
         hashed_password = self.hash_password(password, bytes.fromhex(salt))
-        self.users.append({
-            'username': hashlib.sha256(username.encode()).hexdigest(),
+        user = {
+            'username': hashed_username,
             'password': hashed_password,
             'salt': salt
-        })
-        self.save_users()
+        }
+        self.users[hashed_username] = user
+        self.store.append(user, self.users)
         print("Registration successful!")
         return True
     
@@ -148,9 +1115,9 @@ class LoginSystem:
             print("Options:")
             print("1. Login")
             print("2. Register")
-            choice = input("Enter your choice: ")
+            choice = read_line("Enter your choice: ")
             if choice == "1":
-                username = input("Enter your username: ")
+                username = read_line("Enter your username: ")
                 password = get_password("Enter your password: ")
                 if self.login(username, password):
                     print("Login successful!")
@@ -160,140 +1127,1748 @@ class LoginSystem:
                 else:
                     print("Invalid username or password. Please try again.")
             elif choice == "2":
-                username = input("Enter your desired username: ")
+                username = read_line("Enter your desired username: ")
                 password = get_password("Enter your desired password: ")  # Use getpass here
                 confirm_password = get_password("Confirm your password: ")  # Use getpass here
                 if self.register(username, password, confirm_password):
                     print("Registration successful!")
             else:
-                print("Invalid choice. Please try again.")
+                print("Invalid choice. Please try again.")
+
+    def load_users(self):
+        # Load existing users from 'users.json' and its journal.
+        # If neither file exists, this starts with no users.
+        return self.store.load()
+
+    def save_users(self):
+        # Write the current state of users to a fresh 'users.json' snapshot.
+        self.store.compact(self.users)
+
+    def hash_password(self, password, salt):
+        # Hash a password using PBKDF2 with HMAC-SHA256.
+        # This is a secure way to store passwords.
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000).hex()
+
+
+# Helpers for the binary formats used by FileSystemStore. Strings are stored as a
+# 4-byte little-endian length followed by their UTF-8 bytes.
+def pack_string(text):
+    data = text.encode()
+    return struct.pack('<I', len(data)) + data
+
+
+class BinaryReader:
+    # Read values written with struct and pack_string back out of a bytes-like buffer
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def read(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.position)
+        self.position += struct.calcsize(fmt)
+        return values
+
+    def read_string(self):
+        length, = self.read('<I')
+        text = bytes(self.data[self.position:self.position + length]).decode()
+        self.position += length
+        return text
+
+
+class SnapshotReader:
+    # Read a version 2 or 3 snapshot lazily through a memory map.
+    #
+    # Folders and files start out holding only their name and their offset in the snapshot. A folder's
+    # contents are read the first time they are used, and a file's text every time it is viewed, so
+    # logging in only reads the root. Folders that have been read are kept in least recently used order,
+    # and when more than node_budget files and folders are in memory the oldest unchanged folders are
+    # turned back into unread ones, which drops their entries in the name index and frees their contents.
+    # The text index keeps what it read from their files under each file's offset in the snapshot, so
+    # grep and search do not read the text again when the folder is read back in.
+    CHUNK_SIZE = 1 << 20  # Bytes of a file's text decoded at a time when it is only gone through
+
+    def __init__(self, path, node_budget=1000000):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = self.map[len(FileSystemStore.SNAPSHOT_MAGIC)]
+        self.node_budget = node_budget
+        self.loaded = OrderedDict()  # Folders read from this snapshot, least recently used first
+        self.loaded_nodes = 0  # Number of files and folders created by reading folders
+        self.on_load = None  # Called with each folder after its contents have been read
+        self.on_evict = None  # Called with each folder just before its contents are dropped
+        self.lock = threading.RLock()
+
+    # Read the fixed part of the folder record at position. Returns a BinaryReader positioned at the
+    # list of distances to the folder's contents, the distance back to the start of its subtree,
+    # its (files, folders, bytes) totals, and the number of items in it. Version 2 records have no totals.
+    def read_folder_record(self, position):
+        reader = BinaryReader(self.map, position)
+        reader.read('<B')
+        reader.read_string()
+        start_distance, = reader.read('<Q')
+        totals = reader.read('<QQQ') if self.version >= 3 else (0, 0, 0)
+        count, = reader.read('<I')
+        return reader, start_distance, totals, count
+
+    # Create an unread file or folder for the record at position
+    def read_node(self, position):
+        reader = BinaryReader(self.map, position)
+        kind, = reader.read('<B')
+        name = reader.read_string()
+        if kind == FileSystemStore.FOLDER:
+            item = Folder(name)
+            item.source_offset = position
+            _, _, (item.file_count, item.folder_count, item.byte_size), _ = self.read_folder_record(position)
+        else:
+            item = File(name, None)
+            item.source_offset = reader.position
+            item.size, = reader.read('<I')
+        item.source = self
+        return item
+
+    # Read a folder's contents. Folder records list the distance back to each of their contents.
+    def load_folder(self, folder):
+        with self.lock:
+            if folder.source is not self:
+                return
+            reader, _, _, count = self.read_folder_record(folder.source_offset)
+            for distance in reader.read(f'<{count}Q'):
+                item = self.read_node(folder.source_offset - distance)
+                folder._index[item.name] = item
+                folder.link(item, folder.last)
+                item.parent_directory = folder
+            folder.source = None
+            self.loaded[folder] = None
+            self.loaded_nodes += count
+            if self.on_load is not None:
+                self.on_load(folder)
+
+    def read_text(self, file):
+        reader = BinaryReader(self.map, file.source_offset)
+        return reader.read_string()
+
+    # Yield a file's text in pieces of about CHUNK_SIZE bytes. A character split between two pieces
+    # is held back until the rest of it has been read.
+    def text_chunks(self, file):
+        length, = struct.unpack_from('<I', self.map, file.source_offset)
+        start = file.source_offset + 4
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for position in range(start, start + length, self.CHUNK_SIZE):
+            chunk = decoder.decode(self.map[position:min(position + self.CHUNK_SIZE, start + length)])
+            if chunk:
+                yield chunk
+        decoder.decode(b'', final=True)  # Raises if the text ends partway through a character
+
+    # Mark a folder as recently used
+    def touch(self, folder):
+        with self.lock:
+            if folder in self.loaded:
+                self.loaded.move_to_end(folder)
+
+    # Whether more nodes are loaded than the budget allows
+    @property
+    def over_budget(self):
+        return self.loaded_nodes > self.node_budget
+
+    # Drop the contents of least recently used folders until the budget is met. A folder can only be
+    # dropped if nothing in it has changed, everything in it is unread, none of its files has earlier
+    # versions, which only live in memory, and can_evict(folder) allows it.
+    def evict(self, can_evict):
+        with self.lock:
+            if self.loaded_nodes <= self.node_budget:
+                return
+            for folder in list(self.loaded):
+                if self.loaded_nodes <= self.node_budget:
+                    break
+                if folder.dirty:
+                    del self.loaded[folder]  # Changed folders stay in memory until the next snapshot adopts them
+                    continue
+                if any(item.is_loaded if isinstance(item, Folder) else item.versions is not None
+                       for item in folder._index.values()):
+                    continue
+                if not can_evict(folder):
+                    continue
+                if self.on_evict is not None:
+                    self.on_evict(folder)
+                self.loaded_nodes -= len(folder._index)
+                folder._index = {}
+                folder.first = folder.last = None
+                folder.source = self
+                del self.loaded[folder]
+
+    # Take over the folders and files just written to this snapshot. placed holds each item with the
+    # position of its record, or of its text for a file. Folders in memory stop counting as changed and
+    # join the least recently used order, taking their place in it from previous, the reader they came
+    # from, so they can be dropped like any other. Files let go of their text, and unread folders and
+    # files read from here from now on.
+    def adopt(self, placed, previous):
+        with self.lock:
+            for item, position in placed:
+                if isinstance(item, File):
+                    item.keep_in(self, position)
+                elif item.is_loaded:
+                    item.source_offset = position
+                    item.dirty = False
+                    self.loaded[item] = None
+                    self.loaded_nodes += len(item._index)
+                else:
+                    item.source, item.source_offset = self, position
+            if previous is not None:
+                for folder in previous.loaded:
+                    if folder in self.loaded:
+                        self.loaded.move_to_end(folder)
+                previous.loaded.clear()
+                previous.loaded_nodes = 0
+
+    # Return the bytes between the start of a folder's stored subtree and the end of its record,
+    # and the position of the folder's record within those bytes
+    def subtree_bytes(self, folder):
+        reader, start_distance, _, count = self.read_folder_record(folder.source_offset)
+        end = reader.position + 8 * count
+        start = folder.source_offset - start_distance
+        return self.map[start:end], start_distance
+
+    # Return the raw UTF-8 bytes of a file's text
+    def text_bytes(self, file):
+        length, = struct.unpack_from('<I', self.map, file.source_offset)
+        return self.map[file.source_offset + 4:file.source_offset + 4 + length]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class FileSystemStore:
+    # Keep a user's files and folders on disk as a binary snapshot plus a write-ahead journal.
+    #
+    # Every change to the tree is appended to the journal as a small record with an increasing
+    # sequence number. Records are buffered in memory and a background thread writes and fsyncs
+    # whatever has built up every commit_interval seconds, so a burst of commands shares one fsync
+    # instead of each command waiting for its own. Saving a snapshot writes the whole tree along with
+    # the sequence number of the last change it contains, so on the next login only the journal
+    # records after that number are replayed.
+    SNAPSHOT_MAGIC = b'TVFS'
+    SNAPSHOT_VERSION = 3
+    JOURNAL_MAGIC = b'TVFJ'
+    FOLDER = 0
+    FILE = 1
+    # Journal operations and the number of string arguments each one takes
+    # 'place' puts an item right after the one with the given name, or first if the name is empty, and
+    # 'recycled' records when an item already in the recycle bin was deleted and where from
+    OPERATIONS = {'mkdir': 1, 'write': 2, 'move': 3, 'copy': 2, 'recycle': 2, 'restore': 1, 'delete': 1, 'empty': 0,
+                  'place': 2, 'recycled': 3}
+    OPERATION_CODES = {name: code for code, name in enumerate(OPERATIONS)}
+    OPERATION_NAMES = list(OPERATIONS)
+
+    def __init__(self, username, directory='filesystems', commit_interval=0.05, snapshot_every=10000, node_budget=1000000):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, hashlib.sha256(username.encode()).hexdigest())
+        self.base = base
+        self.generation = 0  # Number of the newest snapshot, which is in snapshot_path
+        self.snapshot_path = self.snapshot_file(0)
+        self.journal_path = base + '.journal'
+        self.commit_interval = commit_interval  # Longest time a change waits in memory before it is written
+        self.snapshot_every = snapshot_every  # Number of journal records after which a new snapshot is due
+        self.sequence = 0  # Sequence number of the last change handed to the journal
+        self.records_since_snapshot = 0
+        self.pending = []  # Encoded records that have not been written yet
+        self.lock = threading.Lock()  # Protects sequence and pending
+        self.io_lock = threading.Lock()  # Serializes writes to the journal and snapshot files
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.journal = None
+        self.committer = threading.Thread(target=self.commit_loop, daemon=True)
+        self.node_budget = node_budget  # Most files and folders to keep in memory from a lazily read snapshot
+        self.reader = None  # The SnapshotReader for the newest snapshot, which the tree is read from
+        self.readers = weakref.WeakSet()  # Every SnapshotReader that undo history may still read from
+
+    @property
+    def needs_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    # A snapshot is never written over, since the one the tree was loaded from stays memory-mapped for
+    # as long as the tree is open, and Windows cannot replace a file that is open. Each snapshot goes to
+    # a new file numbered one higher than the last, and older ones are deleted once nothing reads them.
+    # Number 0 is the name snapshots had before they were numbered.
+    def snapshot_file(self, generation):
+        return f"{self.base}.snapshot" if generation == 0 else f"{self.base}.{generation}.snapshot"
+
+    # The numbers of the snapshots on disk, lowest first, and any snapshots left half written by a crash
+    def find_snapshots(self):
+        directory, prefix = os.path.split(self.base)
+        generations, unfinished = [], []
+        for name in os.listdir(directory or '.'):
+            if not name.startswith(prefix + '.'):
+                continue
+            if name.endswith('.snapshot.tmp'):
+                unfinished.append(os.path.join(directory, name))
+            elif name.endswith('.snapshot'):
+                number = name[len(prefix) + 1:-len('.snapshot')]
+                if number == '' or number.isdigit():
+                    generations.append(int(number or 0))
+        return sorted(generations), unfinished
+
+    # Delete every snapshot but the newest and the ones still being read
+    def remove_old_snapshots(self):
+        generations, unfinished = self.find_snapshots()
+        paths = [self.snapshot_file(generation) for generation in generations if generation != self.generation]
+        reading = {reader.path for reader in self.readers}
+        for path in paths + unfinished:
+            if path not in reading:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+
+    def load(self, terminal):
+        # Rebuild the terminal's tree from the snapshot, then replay the rest of the journal and
+        # start writing new changes. Returns True if anything was found on disk.
+        found = False
+        generations, _ = self.find_snapshots()
+        if generations:
+            self.generation = generations[-1]
+            self.snapshot_path = self.snapshot_file(self.generation)
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                header = f.read(len(self.SNAPSHOT_MAGIC) + 1)
+                if header[len(self.SNAPSHOT_MAGIC):] == b'\x01':
+                    f.seek(0)
+                    self.read_snapshot(terminal, f.read())
+            if header[len(self.SNAPSHOT_MAGIC):] != b'\x01':
+                self.open_snapshot(terminal)
+            found = True
+        except FileNotFoundError:
+            pass
+        snapshot_sequence = self.sequence
+        good_length = len(self.JOURNAL_MAGIC)
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            found = True
+            if data.startswith(self.JOURNAL_MAGIC):
+                for sequence, operation, arguments, end in self.read_journal(data):
+                    if sequence > snapshot_sequence:
+                        terminal.apply_change(operation, arguments)
+                        self.sequence = sequence
+                        self.records_since_snapshot += 1
+                    good_length = end
+        except FileNotFoundError:
+            pass
+        self.journal = open(self.journal_path, 'ab')
+        if self.journal.tell() < len(self.JOURNAL_MAGIC):
+            self.journal.truncate(0)
+            self.journal.write(self.JOURNAL_MAGIC)
+        else:
+            self.journal.truncate(good_length)  # Drop a record that was only partly written before a crash
+        self.journal.flush()
+        self.remove_old_snapshots()  # Left behind by a crash before they could be deleted
+        self.committer.start()
+        return found
+
+    def read_journal(self, data):
+        # Yield (sequence, operation, arguments, end offset) for each complete record in the journal.
+        # Each record is: sequence, operation code, payload length, payload, CRC32 of the payload.
+        reader = BinaryReader(data, len(self.JOURNAL_MAGIC))
+        while reader.position + 13 <= len(data):
+            sequence, code, length = reader.read('<QBI')
+            end = reader.position + length + 4
+            if end > len(data):
+                return
+            payload = data[reader.position:reader.position + length]
+            checksum, = struct.unpack_from('<I', data, reader.position + length)
+            if zlib.crc32(payload) != checksum:
+                return
+            arguments = []
+            payload_reader = BinaryReader(payload)
+            for _ in range(self.OPERATIONS[self.OPERATION_NAMES[code]]):
+                arguments.append(payload_reader.read_string())
+            reader.position = end
+            yield sequence, self.OPERATION_NAMES[code], arguments, end
+
+    def log(self, operation, *arguments):
+        # Queue a change for the journal. This never waits for the disk.
+        payload = b''.join(pack_string(str(argument)) for argument in arguments)
+        with self.lock:
+            if self.closed:
+                return
+            self.sequence += 1
+            self.records_since_snapshot += 1
+            header = struct.pack('<QBI', self.sequence, self.OPERATION_CODES[operation], len(payload))
+            self.pending.append(header + payload + struct.pack('<I', zlib.crc32(payload)))
+            if len(self.pending) == 1:
+                self.wakeup.notify()
+
+    def commit_loop(self):
+        # Write and fsync queued records in groups until the store is closed.
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+            time.sleep(self.commit_interval)  # Let more changes join this group
+            self.flush()
+
+    def flush(self):
+        # Write every queued record to the journal and wait until it is on disk.
+        with self.io_lock:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if records and self.journal is not None:
+                self.journal.write(b''.join(records))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+
+    def save_snapshot(self, terminal, reopen=True):
+        # Write the whole tree to a new snapshot file, which becomes the newest once it is complete,
+        # and empty the journal. Unless the store is closing, the tree is then read from the new
+        # snapshot, so the folders that had changed can be dropped from memory again.
+        with self.io_lock:
+            with self.lock:
+                sequence = self.sequence
+                self.pending = []  # Everything queued so far is part of this snapshot
+                self.records_since_snapshot = 0
+            generation = self.generation + 1
+            path = self.snapshot_file(generation)
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'wb') as f:
+                placed, copied = self.write_snapshot(terminal, sequence, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, path)  # Nothing has this name yet
+            fsync_directory(path)
+            self.generation, self.snapshot_path = generation, path
+            # Records up to sequence are skipped when replaying, so a crash before this point is safe
+            if self.journal is not None:
+                self.journal.truncate(len(self.JOURNAL_MAGIC))
+                os.fsync(self.journal.fileno())
+            if reopen:
+                self.reopen(terminal, placed, copied)
+            self.remove_old_snapshots()
+
+    # Read the tree from the snapshot just written. The text index moves its entries to where their
+    # texts now are: the files it was given, the unread files that were written one by one, and the
+    # texts inside the unread folders copied across as blocks. Entries for texts that were not written
+    # are dropped.
+    def reopen(self, terminal, placed, copied):
+        reader = self.open_reader(terminal, self.snapshot_path)
+        previous, self.reader = self.reader, reader
+        moved = {(item.source, item.source_offset): (reader, position)
+                 for item, position in placed if isinstance(item, File) and item.source is not None}
+        blocks = {}  # Maps each reader copied from to the (start, end, shift) of each block, by start
+        for source, start, end, shift in copied:
+            blocks.setdefault(source, []).append((start, end, shift))
+        for ranges in blocks.values():
+            ranges.sort()
+
+        def move(key):
+            if key in moved:
+                return moved[key]
+            if not isinstance(key, tuple) or key[0] not in blocks:
+                return None
+            ranges = blocks[key[0]]
+            i = bisect.bisect_right(ranges, (key[1], float('inf'))) - 1
+            if i >= 0 and key[1] < ranges[i][1]:
+                return reader, key[1] + ranges[i][2]
+            return None
+
+        reader.adopt(placed, previous)
+        terminal.text_index.rekey(move)
+
+    def write_snapshot(self, terminal, sequence, f):
+        # The snapshot holds a header, every node written after everything inside it, and then the
+        # deletion time and original folder of each recycle bin item. Folder records store how far back
+        # each of their contents is, rather than an absolute offset, so a folder that was never read
+        # from the previous snapshot can be copied across as a single block of bytes.
+        # Returns the items of the tree itself with the positions they were written at, and the
+        # (reader, start, end, shift) of each block copied across. Items reached through a copy that has
+        # not been filled in are written but not returned, since they belong to the folder it copies.
+        buffer = [self.SNAPSHOT_MAGIC, struct.pack('<BQQQ', self.SNAPSHOT_VERSION, sequence, 0, 0)]
+        position = len(self.SNAPSHOT_MAGIC) + struct.calcsize('<BQQQ')
+        placed, copied = [], []
+
+        def write(data):
+            nonlocal buffer, position
+            buffer.append(data)
+            position += len(data)
+            if len(buffer) >= 4096:
+                f.write(b''.join(buffer))
+                buffer = []
+
+        # Write a file, or a folder that was never read, and return the position of its record
+        def write_stored(item, live):
+            start = position
+            if isinstance(item, Folder):
+                data, record_offset = item.source.subtree_bytes(item)
+                copied.append((item.source, item.source_offset - record_offset,
+                               item.source_offset - record_offset + len(data), start + record_offset - item.source_offset))
+                write(data)
+                if live:
+                    placed.append((item, start + record_offset))
+                return start + record_offset
+            text = item.source.text_bytes(item) if item.source is not None else item.text.encode()
+            header = struct.pack('<B', self.FILE) + pack_string(item.name)
+            write(header + struct.pack('<I', len(text)) + text)
+            if live:
+                placed.append((item, start + len(header)))
+            return start
+
+        # Folders from an older snapshot are written out in full so that their records gain totals
+        def is_stored(item):
+            return isinstance(item, File) or (isinstance(item.source, SnapshotReader)
+                                              and item.source.version == self.SNAPSHOT_VERSION)
+
+        # A copy that has not been filled in has the same contents as the folder it was copied from
+        def contents_of(folder):
+            while isinstance(folder.source, LazyCopy):
+                folder = folder.source.original
+            return iter(list(folder.contents))
+
+        root = terminal.root_directory
+        if is_stored(root):
+            root_position = write_stored(root, True)
+        else:
+            # One entry per folder being written: its remaining contents, the positions of those
+            # already written, where its subtree starts, and whether it is part of the tree itself
+            frames = [(root, contents_of(root), [], position, not isinstance(root.source, LazyCopy))]
+            while frames:
+                folder, contents, content_positions, start, live = frames[-1]
+                item = next(contents, None)
+                if item is None:
+                    frames.pop()
+                    record_position = position
+                    if live:
+                        placed.append((folder, record_position))
+                    distances = [record_position - content_position for content_position in content_positions]
+                    write(struct.pack('<B', self.FOLDER) + pack_string(folder.name)
+                          + struct.pack(f'<QQQQI{len(distances)}Q', record_position - start, folder.file_count,
+                                        folder.folder_count, folder.byte_size, len(distances), *distances))
+                    if frames:
+                        frames[-1][2].append(record_position)
+                    else:
+                        root_position = record_position
+                elif not is_stored(item):
+                    frames.append((item, contents_of(item), [], position, live and not isinstance(item.source, LazyCopy)))
+                else:
+                    content_positions.append(write_stored(item, live))
+        metadata_position = position
+        write(struct.pack('<I', len(terminal.recycle_bin_contents)))
+        for item, deleted_at in terminal.recycle_bin_contents.items():
+            origin = terminal.recycle_bin_origins.get(item, terminal.root_directory)
+            if not terminal.in_tree(origin):
+                origin = terminal.root_directory  # Restoring puts it there anyway
+            write(pack_string(item.name) + struct.pack('<d', deleted_at) + pack_string(path_of(origin)))
+        f.write(b''.join(buffer))
+        f.seek(len(self.SNAPSHOT_MAGIC))
+        f.write(struct.pack('<BQQQ', self.SNAPSHOT_VERSION, sequence, root_position, metadata_position))
+        return placed, copied
+
+    def open_reader(self, terminal, path):
+        reader = SnapshotReader(path, self.node_budget)
+        reader.on_load = terminal.folder_loaded
+        reader.on_evict = terminal.folder_evicted
+        self.readers.add(reader)
+        return reader
+
+    def open_snapshot(self, terminal):
+        # Open a version 2 or 3 snapshot lazily. Only the root folder and the recycle bin are read now.
+        reader = self.open_reader(terminal, self.snapshot_path)
+        header = BinaryReader(reader.map, len(self.SNAPSHOT_MAGIC))
+        _, self.sequence, root_position, metadata_position = header.read('<BQQQ')
+        root = reader.read_node(root_position)
+        if reader.version < 3:
+            count_totals(root)
+        self.reader = reader
+        terminal.set_root(root)
+        metadata = BinaryReader(reader.map, metadata_position)
+        count, = metadata.read('<I')
+        for _ in range(count):
+            name = metadata.read_string()
+            deleted_at, = metadata.read('<d')
+            origin = terminal.lookup_path(metadata.read_string())
+            item = terminal.recycle_bin.get(name)
+            if item is not None:
+                terminal.note_recycled(item, deleted_at, origin if isinstance(origin, Folder) else terminal.root_directory)
+
+    # Snapshots written before lazy loading existed (version 1) are read in full
+    def read_snapshot(self, terminal, data):
+        if not data.startswith(self.SNAPSHOT_MAGIC):
+            raise ValueError(f"'{self.snapshot_path}' is not a filesystem snapshot")
+        reader = BinaryReader(data, len(self.SNAPSHOT_MAGIC))
+        _, self.sequence = reader.read('<BQ')
+        root = None
+        open_folders = []  # (folder, number of its contents still to be read)
+        while root is None or open_folders:
+            kind, = reader.read('<B')
+            name = reader.read_string()
+            if kind == self.FOLDER:
+                item = Folder(name)
+                count, = reader.read('<I')
+            else:
+                item = File(name, reader.read_string())
+                count = 0
+            if root is None:
+                root = item
+            else:
+                folder, remaining = open_folders[-1]
+                folder.add_to_folder(item)
+                open_folders[-1] = (folder, remaining - 1)
+            if count:
+                open_folders.append((item, count))
+            while open_folders and open_folders[-1][1] == 0:
+                open_folders.pop()
+        terminal.set_root(root)
+        count, = reader.read('<I')
+        for _ in range(count):
+            name = reader.read_string()
+            deleted_at, = reader.read('<d')
+            origin = terminal.lookup_path(reader.read_string())
+            item = terminal.recycle_bin.get(name)
+            if item is not None:
+                terminal.note_recycled(item, deleted_at, origin or terminal.root_directory)
+
+    def close(self, terminal=None):
+        # Save a final snapshot if a terminal is given, write anything still queued and stop the committer.
+        if terminal is not None:
+            self.save_snapshot(terminal, reopen=False)
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        if self.committer.is_alive():
+            self.committer.join()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        for reader in list(self.readers):
+            reader.close()
+        self.readers = weakref.WeakSet()
+        self.reader = None
+        self.remove_old_snapshots()
+
+
+class ExpiryScheduler:
+    # Call a function for each item once its deadline has passed.
+    # Deadlines are kept in a heap, so the thread sleeps until the earliest one instead of polling,
+    # and each expiry costs O(log n). Scheduling an item with an earlier deadline than any other wakes
+    # the thread up. Cancelled deadlines are left in the heap and skipped when they reach the top.
+    def __init__(self, callback):
+        self.callback = callback  # Called with each expired item, without the scheduler's lock held
+        self.heap = []  # (deadline, tie breaker, item)
+        self.deadlines = {}  # Maps each scheduled item to its current deadline
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def schedule(self, item, deadline):
+        with self.condition:
+            self.deadlines[item] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), item))
+            if self.heap[0][2] is item:
+                self.condition.notify()
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                # Too many cancelled entries have built up, so rebuild the heap without them
+                self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+                heapq.heapify(self.heap)
+
+    def cancel(self, item):
+        with self.condition:
+            self.deadlines.pop(item, None)
+
+    def cancel_all(self):
+        with self.condition:
+            self.deadlines.clear()
+            self.heap = []
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+                        heapq.heappop(self.heap)  # Skip cancelled deadlines
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if not self.running:
+                    return
+                _, _, item = heapq.heappop(self.heap)
+                del self.deadlines[item]
+            self.callback(item)
+
+    # Stop the thread and wait for it to finish
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class NgramIndex:
+    # Finds the names that look most like a mistyped word.
+    # Each name is broken into the overlapping pairs of characters it contains, with a space added at
+    # each end, and every pair points at the names that contain it. Only the names that share a pair
+    # with the word are looked at, so a lookup never has to go through every name. Those are then
+    # scored the way difflib.get_close_matches scores them, so the suggestions are the ones it would
+    # have made.
+    __slots__ = ('size', 'grams', 'names')
+
+    def __init__(self, size=2):
+        self.size = size
+        self.grams = {}  # Maps each pair of characters to the set of names containing it
+        self.names = {}  # Maps each name to how many times it has been added
+
+    def grams_of(self, name):
+        padded = f" {name.lower()} "
+        return {padded[i:i + self.size] for i in range(len(padded) - self.size + 1)}
+
+    def add(self, name):
+        count = self.names.get(name, 0)
+        self.names[name] = count + 1
+        if count == 0:
+            for gram in self.grams_of(name):
+                self.grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        count = self.names.get(name, 0)
+        if count > 1:
+            self.names[name] = count - 1
+        elif count == 1:
+            del self.names[name]
+            for gram in self.grams_of(name):
+                names = self.grams[gram]
+                names.discard(name)
+                if not names:
+                    del self.grams[gram]
+
+    # Return up to n names scoring at least cutoff with difflib.SequenceMatcher, best first.
+    # The lists of names for the word's grams are read rarest first and no more than POSTINGS names
+    # in all. Names are counted by how many of the lists they appear in and only the most promising
+    # CANDIDATES are scored, so the work per lookup is bounded however many millions of names there
+    # are. When every gram of the word is very common this can miss a match, which is fine for a
+    # suggestion.
+    POSTINGS = 2000
+    CANDIDATES = 64
+
+    def suggest(self, word, n=1, cutoff=0.6):
+        lists = sorted((self.grams.get(gram, ()) for gram in self.grams_of(word)), key=len)
+        hits = Counter()
+        budget = self.POSTINGS
+        common = []  # Lists too long to read in full
+        for names in lists:
+            if len(names) <= budget:
+                hits.update(names)
+                budget -= len(names)
+            else:
+                common.append(names)
+        if common and not hits:
+            # Every list is long, so start from the names on the two rarest of them
+            hits.update(common[0] & common[1] if len(common) > 1 else itertools.islice(common[0], self.POSTINGS))
+            common = common[2:]
+        for names in common:
+            hits.update(hits.keys() & names)  # Only count the names already found
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        scored = []
+        for name, _ in hits.most_common(max(self.CANDIDATES, 4 * n)):
+            matcher.set_seq1(name)
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff and matcher.ratio() >= cutoff:
+                scored.append((matcher.ratio(), name))
+        return [name for _, name in heapq.nlargest(n, scored)]
+
+
+# Stands in for sys.stdout or sys.stdin and sends each thread to its own stream, so that sessions
+# served by different threads can each print and read as if they had the console to themselves.
+# Threads that have not redirected anything use the real console.
+class ThreadLocalStream:
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        previous = getattr(self.local, 'stream', None)
+        self.local.stream = stream
+        try:
+            yield previous or self.default
+        finally:
+            self.local.stream = previous
+
+
+# Send this thread's print output to stream, and give back the stream it was going to before
+@contextlib.contextmanager
+def redirect_output(stream):
+    if isinstance(sys.stdout, ThreadLocalStream):
+        with sys.stdout.redirect(stream) as previous:
+            yield previous
+    else:
+        previous = sys.stdout
+        with contextlib.redirect_stdout(stream):
+            yield previous
+
+
+class CommandRegistry:
+    # The commands the terminal understands. Each handler registers itself with a decorator, so the
+    # dispatcher, the help text and the "did you mean" suggestions all come from the same table.
+    def __init__(self):
+        self.handlers = {}  # Maps each command name to (method name, description, whether it takes the line)
+        self.suggestions = NgramIndex()
+        self.readers = {}  # Maps the commands that only read the tree to True, or to a check of the line
+        self.untracked = set()  # Commands that change the tree without being recorded for undo
+
+    # reads is True for a command that never changes the tree, or a function that tells from the
+    # command line whether it will. tracked is False for the commands that move through the undo
+    # history, which must not record themselves in it.
+    def register(self, name, description, reads=False, tracked=True):
+        def decorator(handler):
+            self.handlers[name] = (handler.__name__, description, handler.__code__.co_argcount > 1)
+            self.suggestions.add(name)
+            if reads:
+                self.readers[name] = reads
+            if not tracked:
+                self.untracked.add(name)
+            return handler
+        return decorator
+
+    def lookup(self, name):
+        return self.handlers.get(name.lower())
+
+    # Whether a command line only reads the tree, so it can run alongside other readers.
+    # Unknown commands only print an error.
+    def reads_only(self, line):
+        words = line.split(maxsplit=1)
+        if not words or self.lookup(words[0]) is None:
+            return True
+        reads = self.readers.get(words[0].lower(), False)
+        return reads(line) if callable(reads) else reads
+
+    # Whether the changes a command line makes should be recorded, so the command can be undone
+    def tracked(self, line):
+        words = line.split(maxsplit=1)
+        return bool(words) and words[0].lower() not in self.untracked
+
+
+commands = CommandRegistry()
+
+
+class ReadWriteLock:
+    # Lets any number of threads read at the same time, or one thread write.
+    # A writer waits for the readers already inside to leave, and new readers wait while a writer is
+    # waiting, so a steady stream of reads cannot hold up a write forever. Both sides can be taken
+    # again by a thread that already holds them, and the writer can also read, because a command that
+    # writes (a bash script, say) runs other commands inside it. A reader can never start writing.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0  # Threads holding the lock for reading
+        self.writer = None  # The thread holding the lock for writing
+        self.writer_depth = 0
+        self.waiting_writers = 0
+        self.local = threading.local()  # How many times this thread holds the lock for reading
+
+    @contextlib.contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+            else:
+                depth = getattr(self.local, 'depth', 0)
+                if depth == 0:
+                    while self.writer is not None or self.waiting_writers:
+                        self.condition.wait()
+                    self.readers += 1
+                self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                if self.writer == me:
+                    self.writer_depth -= 1
+                else:
+                    self.local.depth -= 1
+                    if self.local.depth == 0:
+                        self.readers -= 1
+                        if self.readers == 0:
+                            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+            else:
+                if getattr(self.local, 'depth', 0):
+                    raise RuntimeError("cannot write while holding the lock for reading")
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = me
+                self.writer_depth = 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer_depth -= 1
+                if self.writer_depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+class UndoStep:
+    # The changes one command line made to the tree, kept for undo and redo. Each change is either
+    # ('move', item, before, after, source), where before and after are the places the item was moved
+    # between (see Terminal.place_of), None stands for outside the tree and source is the item a copy
+    # was made from, or ('write', file, old text, new text, old versions, new versions). Undoing a step
+    # takes its changes back newest first and redoing it makes them again oldest first, so each change
+    # finds the tree as it left it, and costs about as much as the change itself did.
+    __slots__ = ('label', 'changes', 'taken_at')
+
+    def __init__(self, label):
+        self.label = label  # The command that made the changes, or the name of a snapshot
+        self.changes = []
+        self.taken_at = time.time()
+
+
+class Stats:
+    # Counts and times the commands a terminal runs, for finding the slow ones.
+    # Each command keeps its number of calls and errors, its total and longest time, and a histogram
+    # of its times in power-of-two microsecond buckets, from which percentiles are read. Other
+    # counters, such as the nodes visited by searches or the bytes written from the editor, are kept
+    # by name. While it is turned off the only cost is one check of `enabled` per command.
+    def __init__(self):
+        self.enabled = False
+        self.commands = {}  # Maps each command name to [calls, errors, total seconds, longest seconds, histogram]
+        self.counters = Counter()
+        self.since = time.time()
+        self.export_path = None  # Where to write the stats every export_interval seconds, if anywhere
+        self.export_interval = 60
+        self.exported_at = 0
+        self.lock = threading.Lock()  # Sessions running side by side record at the same time
+
+    def record(self, name, seconds, failed):
+        bucket = int(seconds * 1000000).bit_length()  # Bucket b holds times below 2**b microseconds
+        with self.lock:
+            entry = self.commands.get(name)
+            if entry is None:
+                entry = self.commands[name] = [0, 0, 0.0, 0.0, []]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+            histogram = entry[4]
+            if bucket >= len(histogram):
+                histogram.extend([0] * (bucket + 1 - len(histogram)))
+            histogram[bucket] += 1
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def reset(self):
+        with self.lock:
+            self.commands.clear()
+            self.counters.clear()
+            self.since = time.time()
+
+    # The time below which the given fraction of calls finished, rounded up to a bucket boundary
+    @staticmethod
+    def percentile(histogram, fraction):
+        wanted = fraction * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= wanted:
+                return (1 << bucket) / 1000000
+        return 0.0
+
+    def as_dict(self):
+        with self.lock:
+            commands = {}
+            for name, (calls, errors, total, longest, histogram) in sorted(self.commands.items()):
+                commands[name] = {
+                    'calls': calls,
+                    'errors': errors,
+                    'total_ms': round(total * 1000, 3),
+                    'mean_ms': round(total * 1000 / calls, 3),
+                    'p50_ms': round(min(self.percentile(histogram, 0.5), longest) * 1000, 3),
+                    'p99_ms': round(min(self.percentile(histogram, 0.99), longest) * 1000, 3),
+                    'max_ms': round(longest * 1000, 3),
+                    'histogram_us': {f"<{1 << bucket}": count for bucket, count in enumerate(histogram) if count},
+                }
+            return {'enabled': self.enabled, 'since': self.since, 'seconds': round(time.time() - self.since, 3),
+                    'commands': commands, 'counters': dict(self.counters)}
+
+    # Write the stats to a JSON file. The file is replaced in one step, so readers never see half of it.
+    def dump(self, path):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.as_dict(), file, indent=2)
+        os.replace(temporary, path)
+
+    # Called after each command: write the export file if it is due
+    def export_if_due(self):
+        if self.export_path is not None and time.time() - self.exported_at >= self.export_interval:
+            self.exported_at = time.time()
+            try:
+                self.dump(self.export_path)
+            except OSError as error:
+                print(f"Could not export stats to '{self.export_path}': {error}")
+                self.export_path = None
+
+
+class Terminal:
+    BATCH_BUFFER_SIZE = 1 << 20  # Characters of output a batch script collects before writing them out
+    TREE_BLOCK_LINES = 1000  # Lines of a tree drawing written out at a time
+    UNDO_LIMIT = 200  # Most command lines that can be undone
+    UNDO_CHANGE_BUDGET = 1000000  # Most changes kept in the undo history
+
+    def __init__(self, username, storage_directory='filesystems', recycle_bin_ttl=120):
+        self.line_number = 1
+        self.user = username
+        self.lock = ReadWriteLock()  # Read by commands that only look at the tree, written by everything that changes it
+        self.recycle_bin_contents = {}  # Maps each item in the recycle bin to the time it was deleted
+        self.recycle_bin_origins = {}  # Maps each item in the recycle bin to the folder it was deleted from
+        self.recycle_bin_ttl = recycle_bin_ttl  # Seconds an item stays in the recycle bin before it is deleted for good
+        self.failed = False  # Whether the last command printed an error
+        self.last_error = None
+        self.depth = 0  # Commands running, since a script runs its commands inside the bash command
+        self.ending = None  # 'logout' or 'exit' once one of them has run, to close the tree after the command
+        self.expiry = ExpiryScheduler(self.expire_item)
+        self.sessions = weakref.WeakSet()  # Other sessions working on this tree, when it is served over the network
+        self.stats = Stats()  # Timings and counters, collected while turned on with the stats command
+        self.history = []  # UndoSteps of the command lines that changed the tree, oldest first, for undo
+        self.future = []  # UndoSteps that have been undone, last undone first, for redo
+        self.history_changes = 0  # Changes held by the steps in history
+        self.recording = None  # The UndoStep of the command line running now, if it is to be undone
+        # Counts of the references the undo history and the recycle bin hold to each file and folder.
+        # A folder holding any of them is never dropped from memory, since the objects it holds would be
+        # replaced by new ones when it is read back in.
+        self.pinned = Counter()
+        root_directory = Folder("root")  # Create a root folder
+        root_directory.add_to_folder(Folder("recycle_bin"))  # Add the recycle bin to the root directory
+        self.set_root(root_directory)
+        # Load the user's saved files and folders, unless storage_directory is None
+        self.store = None
+        if storage_directory is not None:
+            store = FileSystemStore(username, storage_directory)
+            store.load(self)
+            self.store = store  # Set only now so that replaying the journal does not log the changes again
+        for item, deleted_at in self.recycle_bin_contents.items():
+            self.expiry.schedule(item, deleted_at + self.recycle_bin_ttl)
+        self.expiry.start()
+
+    # Make the given folder the root of the tree, and index everything in it
+    def set_root(self, root_directory):
+        root_directory.parent_directory = None
+        self.root_directory = root_directory  # Store the root directory for later use
+        self.current_directory = root_directory  # Initialize the current directory to the root folder
+        self.recycle_bin = root_directory.get("recycle_bin")
+        self.index = TreeIndex()  # Index of every file and folder in the tree by name
+        self.index.add(self.root_directory)
+        self.text_index = TextIndex()  # Index of the text of the files grep and search have gone through
+
+    # The Terminal that owns the tree and its undo history: this one, or the owner of a session
+    @property
+    def tree_owner(self):
+        return self
+
+    # Add a step to the undo history, dropping the oldest ones once there are too many or they hold
+    # too many changes. Anything undone before can no longer be redone.
+    def remember(self, step):
+        self.history.append(step)
+        self.history_changes += len(step.changes)
+        self.pin_step(step, 1)
+        for undone in self.future:
+            self.pin_step(undone, -1)
+        self.future.clear()
+        while len(self.history) > self.UNDO_LIMIT or (len(self.history) > 1 and self.history_changes > self.UNDO_CHANGE_BUDGET):
+            dropped = self.history.pop(0)
+            self.history_changes -= len(dropped.changes)
+            self.pin_step(dropped, -1)
+
+    # Add count to the pins on everything a step refers to
+    def pin_step(self, step, count):
+        for change in step.changes:
+            if change[0] == 'move':
+                _, item, before, after, source = change
+                items = [item, source]
+                for place in (before, after):
+                    if place is not None:
+                        folder, _, previous, recycled = place
+                        items += [folder, previous, recycled and recycled[1]]
+            else:
+                items = [change[1]]
+            self.pin([item for item in items if item is not None], count)
+
+    # Add count to the pins on each of items, forgetting the ones left with none
+    def pin(self, items, count):
+        pinned = self.tree_owner.pinned
+        for item in items:
+            pinned[item] += count
+            if pinned[item] <= 0:
+                del pinned[item]
+
+    # Where an item is now, for the undo history: its folder, its name, the item listed before it, and
+    # the time it was deleted and the folder it was deleted from if it is in the recycle bin
+    def place_of(self, item):
+        deleted_at = self.recycle_bin_contents.get(item)
+        recycled = None if deleted_at is None else (deleted_at, self.recycle_bin_origins.get(item))
+        return item.parent_directory, item.name, item.previous, recycled
+
+    # Add a change to the step being recorded: item went from the place before to the place after
+    def record_move(self, item, before, after, source=None):
+        step = self.tree_owner.recording
+        if step is not None:
+            step.changes.append(('move', item, before, after, source))
+
+    # Take back the changes of a step, newest first
+    def undo_step(self, step):
+        moved, remade = [], []
+        for change in reversed(step.changes):
+            if change[0] == 'move':
+                _, item, before, after, source = change
+                if self.put(item, before):
+                    remade.append(item)
+                moved.append(item)
+            else:
+                _, file, old_text, new_text, old_versions, new_versions = change
+                self.rewrite(file, old_text, old_versions)
+        self.log_recycled(moved, remade)
+
+    # Make the changes of an undone step again, oldest first
+    def redo_step(self, step):
+        moved, remade = [], []
+        for change in step.changes:
+            if change[0] == 'move':
+                _, item, before, after, source = change
+                if self.put(item, after, source):
+                    remade.append(item)
+                moved.append(item)
+            else:
+                _, file, old_text, new_text, old_versions, new_versions = change
+                self.rewrite(file, new_text, new_versions)
+        self.log_recycled(moved, remade)
 
-    def load_users(self):
-        # Load existing users from a JSON file named 'users.json'.
-        try:
-            with open('users.json') as f:
-                data = json.load(f)
-            return data['users']
-        except FileNotFoundError:
-            # If the file doesn't exist, return an empty list.
-            return []
+    # Journal when and where from the items a step put back in the recycle bin were deleted. This waits
+    # until the whole step is done, since an item's original folder may be one the step puts back later.
+    # Folders the step made again from journal records are new folders when the journal is read back,
+    # so items in the recycle bin that were deleted from inside them are journaled again too.
+    def log_recycled(self, moved, remade):
+        items = moved
+        remade = {item for item in remade if isinstance(item, Folder) and self.in_tree(item)}
+        if remade:
+            items = items + [item for item, origin in self.recycle_bin_origins.items()
+                             if self.in_tree(origin) and any(folder in remade for folder in self.folders_above(origin))]
+        for item in dict.fromkeys(items):
+            deleted_at = self.recycle_bin_contents.get(item)
+            if deleted_at is not None and item.parent_directory is self.recycle_bin:
+                origin = self.recycle_bin_origins[item]
+                self.log('recycled', item.name, deleted_at, path_of(origin if self.in_tree(origin) else self.root_directory))
 
-    def save_users(self):
-        # Save the current state of users to the 'users.json' file.
-        with open('users.json', 'w') as f:
-            json.dump({'users': self.users}, f)
+    # Yield a folder and every folder above it up to the root
+    def folders_above(self, folder):
+        while folder is not None:
+            yield folder
+            folder = folder.parent_directory
 
-    def hash_password(self, password, salt):
-        # Hash a password using PBKDF2 with HMAC-SHA256.
-        # This is a secure way to store passwords.
-        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000).hex()
+    # Move an item to a place from the undo history, or out of the tree if place is None. An item that
+    # is not in the tree, because it was deleted for good or has expired from the recycle bin since,
+    # is put back with journal records that make it and everything in it again, or that copy it again
+    # from source if it is a copy whose original is still there. A change that no longer fits the tree,
+    # because something has expired from the recycle bin in the meantime, is left out. Returns whether
+    # the item was made again.
+    def put(self, item, place, source=None):
+        here = self.in_tree(item)
+        if place is None:
+            if here:
+                self.delete_item(item.parent_directory, item)
+            return
+        folder, name, previous, recycled = place
+        parent = item.parent_directory if here else None
+        if not self.in_tree(folder) or folder.get(name) not in (None, item) or (parent is not folder and folder.get(name) is item):
+            return
+        old_name = item.name
+        if here:
+            if parent is self.recycle_bin:
+                self.forget_recycled(item)
+                self.expiry.cancel(item)
+            if parent is not folder or name != old_name:
+                old_path = path_of(item)
+                if parent is folder:
+                    folder.rename_item(item, name)
+                else:
+                    parent.remove_from_folder(item)
+                    item.name = sys.intern(name)
+                    folder.add_to_folder(item)
+                if item.name != old_name:
+                    self.index.rename(item, old_name)
+                self.log('move', old_path, path_of(folder), item.name)
+        else:
+            if item.parent_directory is not None:  # Still held by a folder that has left the tree since
+                item.parent_directory.remove_from_folder(item)
+            item.name = sys.intern(name)
+            folder.add_to_folder(item)
+            self.index.add(item)
+            if source is not None and self.in_tree(source) and source.name == item.name:
+                self.log('copy', path_of(source), path_of(folder))
+            else:
+                self.journal_tree(item)
+        if isinstance(item, Folder) or not self.text_index.has(item):
+            self.text_index.changed(folder)
+        if item.previous is not previous and (previous is None or folder.get(previous.name) is previous):
+            self.place_item(folder, item, previous)
+        if recycled is not None and folder is self.recycle_bin:
+            deleted_at, origin = recycled
+            self.note_recycled(item, deleted_at, origin)
+            self.expiry.schedule(item, deleted_at + self.recycle_bin_ttl)
+        return not here
 
-    def login(self, username, password):
-        # Check if a user with the given username and password exists in the system.
-        for user in self.users:
-            if user['username'] == hashlib.sha256(username.encode()).hexdigest():
-                if user['password'] == self.hash_password(password, bytes.fromhex(user['salt'])):
-                    return True
-        return False
+    # Give a file the text and version history it had at some point in the undo history
+    def rewrite(self, file, text, versions):
+        file.text = text
+        file.versions = versions
+        if self.in_tree(file):
+            self.log('write', path_of(file), text)
+        self.text_index.update(file)
 
+    # Write journal records that make item and everything in it, for an item that comes back into the
+    # tree after it was deleted for good
+    def journal_tree(self, item):
+        stack = [(item, path_of(item))]
+        while stack:
+            item, path = stack.pop()
+            if isinstance(item, Folder):
+                self.log('mkdir', path)
+                stack.extend((content, join_path(path, content.name)) for content in reversed(item.contents))
+            else:
+                self.log('write', path, item.text)
 
-class Terminal:
-    def __init__(self, username):
-        self.line_number = 1
-        self.user = username
-        self.current_directory = Folder("root")  # Initialize the current directory to a root folder
-        self.current_directory.parent_directory = None
-        self.root_directory = self.current_directory  # Store the root directory for later use
-        self.recycle_bin = Folder("recycle_bin")  # Create a new recycle bin directory
-        self.root_directory.add_to_folder(self.recycle_bin)  # Add the recycle bin to the root directory
-        self.recycle_bin_contents = {}
-        self.running = True
-        self.recycle_bin_thread = threading.Thread(target=self.check_recycle_bin)
-        self.recycle_bin_thread.start()
+    # Move the working directory of everyone on the tree up to the closest folder still in the tree
+    def find_working_directories(self):
+        for terminal in [self] + list(self.sessions):
+            folder = terminal.current_directory
+            while not self.in_tree(folder):
+                folder = folder.parent_directory or self.root_directory
+            terminal.current_directory = folder
+
+    def prompt(self):
+        return f"\033[1;30m@{self.user}\033[0m \033[1;34m[{self.line_number}]\033[0m \033[1;32m${self.current_directory.name}\033[0m:"
 
     def get_line(self):
-        print(f"\033[1;30m@{self.user}\033[0m \033[1;34m[{self.line_number}]\033[0m \033[1;32m${self.current_directory.name}\033[0m:", end=' ', flush=True)
+        print(self.prompt(), end=' ', flush=True)
+        keyboard = get_keyboard()
         line = ''
-        while True:
-            char = msvcrt.getwch()
-            if char == '\r':  # Enter key
-                print('\n', end='', flush=True)  # Move to a new line
-                break
-            elif char == '\b':  # Backspace key
-                if line:
-                    print('\b \b', end='', flush=True)  # Erase the last character
-                    line = line[:-1]
-            elif char == ' ' and line.strip() != '':
-                print('\033[0m', end='', flush=True)  # Reset color to default
-                line += char
-                print(char,end='', flush=True)
-            elif line.strip() == '':
-                print('\033[93m', end='', flush=True)  # Set color to yellow
-                line += char
-                print(char, end='', flush=True)
-            else:
-                line += char
-                print(char, end='', flush=True)
+        with keyboard.session():
+            while True:
+                keys = keyboard.read()
+                echo = []  # Everything this batch of keys draws, written out in one go
+                entered = False
+                for position, char in enumerate(keys):
+                    if char == '\r':  # Enter key
+                        keyboard.unread(keys[position + 1:])  # Anything typed after Enter belongs to the next line
+                        echo.append('\n')  # Move to a new line
+                        entered = True
+                        break
+                    elif char == '\b':  # Backspace key
+                        if line:
+                            echo.append('\b \b')  # Erase the last character
+                            line = line[:-1]
+                    elif not char.isprintable():
+                        continue  # Other control keys
+                    elif char == ' ' and line.strip() != '':
+                        echo.append('\033[0m')  # Reset color to default
+                        line += char
+                        echo.append(char)
+                    elif line.strip() == '':
+                        echo.append('\033[93m')  # Set color to yellow
+                        line += char
+                        echo.append(char)
+                    else:
+                        line += char
+                        echo.append(char)
+                sys.stdout.write(''.join(echo))
+                sys.stdout.flush()
+                if entered:
+                    break
         self.line_number += 1  # Increment line number here
         return line.strip()
 
+    # Find the file or folder at a full path by looking up each name in the folder above it. Folders
+    # along the path that have not been read from a lazily loaded snapshot yet are read on the way.
+    def lookup_path(self, path):
+        item = self.root_directory
+        if path == "/":
+            return item
+        for name in path.strip("/").split("/"):
+            if not isinstance(item, Folder):
+                return None
+            item = item.get(name)
+            if item is None:
+                return None
+        return item
+
+    # Called after a folder's contents are read from a snapshot or filled in from a copy, to index
+    # their names. Their text is only read and indexed once grep or search goes through the folder.
+    def folder_loaded(self, folder):
+        if not self.in_tree(folder):
+            return  # The folder is no longer in the tree
+        for content in folder._index.values():
+            self.index.add(content)
+
+    # Called by the SnapshotReader before it drops a folder's contents. What the text index has read
+    # from its files is kept, but the files themselves are let go.
+    def folder_evicted(self, folder):
+        self.text_index.evicted(folder)
+        if not self.in_tree(folder):
+            return  # The folder is no longer in the tree
+        for content in folder._index.values():
+            self.index.remove(content)
+
+    # Keep a lazily loaded tree within its memory budget. This only runs between commands, so no
+    # command is ever holding on to a folder that gets dropped. The current directory of every
+    # session and the folders above them are never dropped, and neither are folders holding pinned items.
+    def evict_unused_folders(self):
+        if self.store is not None and self.store.reader is not None:
+            working = [self.current_directory] + [session.current_directory for session in self.sessions]
+            self.store.reader.evict(lambda folder: not any(self.is_inside(directory, folder) for directory in working)
+                                    and not any(content in self.pinned for content in folder._index.values()))
+
+    # Mark a folder as recently used, so it is the last to be dropped from memory
+    def touch(self, folder):
+        if self.store is not None and self.store.reader is not None:
+            self.store.reader.touch(folder)
+
+    # All changes to the tree go through the methods below. They keep the index up to date
+    # and record each change in the user's filesystem journal so it survives logging out.
+
+    def log(self, operation, *arguments):
+        if self.store is not None:
+            self.store.log(operation, *arguments)
+
+    def create_folder(self, parent, name):
+        folder = Folder(name)
+        parent.add_to_folder(folder)
+        self.index.add(folder)
+        self.record_move(folder, None, self.place_of(folder))
+        self.log('mkdir', path_of(folder))
+        return folder
+
+    def create_file(self, parent, name, text):
+        file = File(name, text)
+        parent.add_to_folder(file)
+        self.index.add(file)
+        self.text_index.add(file)
+        self.record_move(file, None, self.place_of(file))
+        self.log('write', path_of(file), text)
+        if self.stats.enabled:
+            self.stats.add('editor_bytes_written', file.size)
+        return file
+
+    # Replace the text of a file, keeping the old text in its version history
+    def write_file(self, file, text):
+        old_text = file.text
+        old_versions = file.versions.copy() if file.versions is not None else None
+        file.text = text
+        if file.text != old_text:
+            if file.versions is None:
+                file.versions = VersionHistory(old_text)
+            file.versions.add(old_text, file.text)
+        self.text_index.update(file)
+        step = self.tree_owner.recording
+        if step is not None:
+            step.changes.append(('write', file, old_text, file.text, old_versions, file.versions))
+        self.log('write', path_of(file), text)
+        if self.stats.enabled:
+            self.stats.add('editor_bytes_written', file.size)
+
+    # Move an item out of folder into destination, optionally giving it a new name.
+    # Renaming an item inside the same folder keeps its position in the listing.
+    def move_item(self, folder, item, destination, new_name=None):
+        old_path = join_path(path_of(folder), item.name)
+        old_name = item.name
+        before = self.place_of(item)
+        if destination is folder:
+            folder.rename_item(item, new_name or item.name)
+        else:
+            folder.remove_from_folder(item)
+            if new_name:
+                item.name = sys.intern(new_name)
+            destination.add_to_folder(item)
+        if isinstance(item, Folder) or not self.text_index.has(item):
+            self.text_index.changed(destination)
+        if folder is self.recycle_bin and destination is not folder:  # Moved out of the recycle bin
+            self.forget_recycled(item)
+            self.expiry.cancel(item)
+        if item.name != old_name:
+            self.index.rename(item, old_name)
+        self.record_move(item, before, self.place_of(item))
+        self.log('move', old_path, path_of(destination), item.name)
+
+    # Copy an item into destination. Folders are copied lazily and file text is shared, so this is O(1).
+    def copy_item(self, item, destination):
+        copy = item.copy(self.folder_loaded)
+        destination.add_to_folder(copy)
+        self.index.add(copy)
+        self.record_move(copy, None, self.place_of(copy), item)
+        self.text_index.changed(destination)  # The copy is indexed when grep or search next goes through it
+        self.log('copy', path_of(item), path_of(destination))
+
+    # Move an item from folder into the recycle bin, renaming it if the bin already holds that name.
+    # Returns True if the item had to be renamed.
+    def recycle_item(self, folder, item, deleted_at=None):
+        old_path = join_path(path_of(folder), item.name)
+        deleted_at = time.time() if deleted_at is None else deleted_at
+        old_name = item.name
+        before = self.place_of(item)
+        folder.remove_from_folder(item)
+        renamed = False
+        if self.recycle_bin.get(item.name):
+            # Add the first free suffix, _1, _2 and so on
+            suffix = 1
+            while self.recycle_bin.get(f"{item.name}_{suffix}"):
+                suffix += 1
+            item.name = sys.intern(f"{item.name}_{suffix}")
+            renamed = True
+        self.recycle_bin.add_to_folder(item)
+        if isinstance(item, Folder) or not self.text_index.has(item):
+            self.text_index.changed(self.recycle_bin)
+        if renamed:
+            self.index.rename(item, old_name)
+        self.note_recycled(item, deleted_at, folder)
+        self.expiry.schedule(item, deleted_at + self.recycle_bin_ttl)
+        self.record_move(item, before, self.place_of(item))
+        self.log('recycle', old_path, deleted_at)
+        return renamed
+
+    # Remember that item is in the recycle bin, deleted at deleted_at from origin. Both are pinned, so
+    # that neither is replaced by a new object when the folder holding it is dropped from memory.
+    def note_recycled(self, item, deleted_at, origin):
+        self.forget_recycled(item)
+        self.recycle_bin_contents[item] = deleted_at
+        self.recycle_bin_origins[item] = origin
+        self.pin([item, origin], 1)
+
+    def forget_recycled(self, item):
+        if item in self.recycle_bin_contents:
+            del self.recycle_bin_contents[item]
+            self.pin([item, self.recycle_bin_origins.pop(item)], -1)
+
+    def forget_all_recycled(self):
+        for item in list(self.recycle_bin_contents):
+            self.forget_recycled(item)
+
+    # The folder an item in the recycle bin goes back to: the one it was deleted from, or the root if
+    # that folder no longer exists or has been moved into the item since
+    def restore_destination(self, item):
+        parent_directory = self.recycle_bin_origins.get(item, self.root_directory)
+        if not self.in_tree(parent_directory):
+            parent_directory = self.root_directory  # The original folder no longer exists
+        elif item in self.folders_above(parent_directory):
+            parent_directory = self.root_directory  # The original folder has been moved into the item itself
+        return parent_directory
+
+    # Put an item from the recycle bin back where it was deleted from.
+    # Returns False if something with the same name is already there.
+    def restore_item(self, item):
+        parent_directory = self.restore_destination(item)
+        if parent_directory.get(item.name):
+            return False
+        self.log('restore', item.name)
+        before = self.place_of(item)
+        self.recycle_bin.remove_from_folder(item)
+        self.forget_recycled(item)
+        self.expiry.cancel(item)
+        parent_directory.add_to_folder(item)
+        if isinstance(item, Folder) or not self.text_index.has(item):
+            self.text_index.changed(parent_directory)
+        self.record_move(item, before, self.place_of(item))
+        return True
+
+    # Permanently delete an item from folder
+    def delete_item(self, folder, item):
+        path = join_path(path_of(folder), item.name)
+        before = self.place_of(item)
+        self.index.remove(item)
+        self.text_index.remove_tree(item)
+        folder.remove_from_folder(item)
+        self.forget_recycled(item)
+        self.expiry.cancel(item)
+        self.record_move(item, before, None)
+        self.log('delete', path)
+
+    # Move an item inside folder so that it is listed right after previous, or first if previous is None
+    def place_item(self, folder, item, previous):
+        folder.move_after(item, previous)
+        self.log('place', path_of(item), previous.name if previous is not None else '')
+
+    # Permanently delete everything in the recycle bin
+    def empty_recycle_bin(self):
+        contents = self.recycle_bin.contents
+        for content in reversed(contents):  # Undo puts them back first to last
+            self.index.remove(content)
+            self.text_index.remove_tree(content)
+            self.record_move(content, self.place_of(content), None)
+        self.recycle_bin.clear()
+        self.forget_all_recycled()
+        self.expiry.cancel_all()
+        self.log('empty')
+
+    # Apply a change read back from the filesystem journal
+    def apply_change(self, operation, arguments):
+        def parent_and_item(path):
+            parent = self.lookup_path(path.rsplit("/", 1)[0] or "/")
+            if not isinstance(parent, Folder):
+                return None, None
+            return parent, parent.get(path.rsplit("/", 1)[1])
+
+        # A record that names something missing from the tree is reported and skipped, so one bad record
+        # cannot stop the rest of the tree from being read back
+        if operation == 'mkdir':
+            parent, item = parent_and_item(arguments[0])
+            if parent is not None and item is None:
+                self.create_folder(parent, arguments[0].rsplit("/", 1)[1])
+                return
+        elif operation == 'write':
+            parent, item = parent_and_item(arguments[0])
+            if isinstance(item, File):
+                self.write_file(item, arguments[1])
+                return
+            if parent is not None and item is None:
+                self.create_file(parent, arguments[0].rsplit("/", 1)[1], arguments[1])
+                return
+        elif operation == 'move':
+            parent, item = parent_and_item(arguments[0])
+            destination = self.lookup_path(arguments[1])
+            if item is not None and isinstance(destination, Folder) and destination.get(arguments[2]) is None:
+                self.move_item(parent, item, destination, arguments[2])
+                return
+        elif operation == 'copy':
+            item, destination = self.lookup_path(arguments[0]), self.lookup_path(arguments[1])
+            if item is not None and isinstance(destination, Folder):
+                self.copy_item(item, destination)
+                return
+        elif operation == 'recycle':
+            parent, item = parent_and_item(arguments[0])
+            if item is not None:
+                self.recycle_item(parent, item, float(arguments[1]))
+                return
+        elif operation == 'restore':
+            item = self.recycle_bin.get(arguments[0])
+            if item is not None:  # Items made inside the recycle bin are restored too, to the root
+                self.restore_item(item)
+                return
+        elif operation == 'delete':
+            parent, item = parent_and_item(arguments[0])
+            if item is not None:
+                self.delete_item(parent, item)
+                return
+        elif operation == 'empty':
+            self.empty_recycle_bin()
+            return
+        elif operation == 'place':
+            parent, item = parent_and_item(arguments[0])
+            previous = parent.get(arguments[1]) if parent is not None and arguments[1] else None
+            if item is not None and (previous is not None or not arguments[1]):
+                self.place_item(parent, item, previous)
+                return
+        elif operation == 'recycled':
+            item, origin = self.recycle_bin.get(arguments[0]), self.lookup_path(arguments[2])
+            if item is not None:
+                self.note_recycled(item, float(arguments[1]), origin if isinstance(origin, Folder) else self.root_directory)
+                return
+        print(f"Skipped a change that could not be applied: {operation} {' '.join(map(str, arguments[:1]))}")
+
+    # Permanently delete an item whose time in the recycle bin is up. This runs on the scheduler's thread.
+    def expire_item(self, item):
+        with self.lock.write():
+            deleted_at = self.recycle_bin_contents.get(item)
+            # The item may have been restored, or restored and deleted again, since it was scheduled
+            if deleted_at is None or time.time() < deleted_at + self.recycle_bin_ttl:
+                return
+            if self.recycle_bin.get(item.name) is item:
+                self.delete_item(self.recycle_bin, item)
+            else:
+                self.forget_recycled(item)
+
+    # Stop removing expired items from the recycle bin, then save a snapshot of the tree and stop
+    # writing to the journal
+    def close(self):
+        self.expiry.stop()
+        with self.lock.write():
+            self.save_filesystem()
+
+    # Save a snapshot of the tree and stop writing to the journal
+    def save_filesystem(self):
+        if self.store is not None:
+            self.store.close(self)
+            self.store = None
+
+    # Print an error message and remember that the current command failed, so scripts can stop on it
+    def error(self, message):
+        print(message)
+        self.failed = True
+        self.last_error = message
+
+    # Check a name given to a new or renamed item. Paths are split on '/', so a name containing one
+    # could never be found again, and its journal records could not be read back.
+    def valid_name(self, name):
+        if "/" in name:
+            self.error(f"'{name}' is not a valid name: names cannot contain '/'.")
+            return False
+        return True
+
+    # Logging out and exiting close the tree once the command has finished and let go of the lock,
+    # since closing waits for the recycle bin's thread, which may itself be waiting for the lock
+    @commands.register('exit', 'Exit the terminal')
     def exit_command(self):
         print("Exiting terminal.")
         print('\033[0m', end='', flush=True)  # Reset color to default
-        os._exit(0)
+        self.ending = 'exit'
+        return False
 
+    @commands.register('cls', 'Clear the screen', reads=True)
     def cls_command(self):
         os.system('cls' if os.name == 'nt' else 'clear')
 
+    @commands.register('logout', 'Log out of the terminal')
     def logout_command(self):
         print("Logging out.")
         print('\033[0m', end='', flush=True)  # Reset color to default
-        LoginSystem.run(self)
-        #return False  # Return False to signal that we want to exit the terminal
+        self.ending = 'logout'
+        return False  # Return False to signal that we want to exit the terminal
 
+    @commands.register('mkdir', 'Create a new directory')
     def mkdir_command(self, line):
         folder_name = line[6:]  # Get the folder name from the command
         if folder_name:  # Check if a folder name was provided
             if self.current_directory.name == "recycle_bin":
-                print("Cannot create folders in the recycle bin.")
+                self.error("Cannot create folders in the recycle bin.")
+            elif not self.valid_name(folder_name):
+                return
+            elif self.current_directory.get(folder_name):
+                self.error(f"A file or folder with the name '{folder_name}' already exists.")
             else:
-                new_folder = Folder(folder_name)
-                self.current_directory.add_to_folder(new_folder)
+                self.create_folder(self.current_directory, folder_name)
                 print(f"Folder '{folder_name}' created successfully.")
         else:
-            print("Please provide a folder name.")
+            self.error("Please provide a folder name.")
 
+    # Draw the tree under the current directory, or under the root with 'tree root'.
+    # --depth N stops N levels down, --dirs-only leaves out files and --max N stops after N lines.
+    # Lines are written out in blocks rather than one print each.
+    @commands.register('tree', 'Display the directory structure (tree [root] [--depth N] [--dirs-only] [--max N])', reads=True)
     def tree_command(self, line):
-        args = line.split()
-        if len(args) == 1:  # If only 'tree' is typed
-            self.current_directory.display()
-        elif len(args) == 2 and args[1] == 'root':  # If 'tree root' is typed
-            self.root_directory.display()
-        else:
-            print("Invalid command")
+        args = line.split()[1:]
+        folder = self.current_directory
+        options = {'--depth': None, '--max': None}
+        dirs_only = False
+        while args:
+            arg = args.pop(0)
+            if arg == 'root' and folder is self.current_directory:
+                folder = self.root_directory
+            elif arg == '--dirs-only':
+                dirs_only = True
+            elif arg in options and args and args[0].isdigit():
+                options[arg] = int(args.pop(0))
+            else:
+                self.error("Invalid syntax. Usage: tree [root] [--depth N] [--dirs-only] [--max N]")
+                return
+        lines = 0
+        block = []
+        for text in folder.render(options['--depth'], dirs_only, options['--max']):
+            block.append(text)
+            if len(block) >= self.TREE_BLOCK_LINES:
+                sys.stdout.write('\n'.join(block) + '\n')
+                lines += len(block)
+                block.clear()
+        if block:
+            sys.stdout.write('\n'.join(block) + '\n')
+            lines += len(block)
+        if self.stats.enabled:
+            self.stats.add('nodes_visited', lines)
 
+    @commands.register('help', 'Display this help message', reads=True)
     def help_command(self):
-        commands = {
-            "cls": "Clear the screen",
-            "exit": "Exit the terminal",
-            "help": "Display this help message",
-            "logout": "Log out of the terminal",
-            "mkdir": "Create a new directory",
-            "tree": "Display the directory structure",
-            "yosdadasdas": "nothing"
-        }
-
-        max_length = max(len(command) for command in commands)
+        max_length = max(len(command) for command in commands.handlers)
 
         print("Available commands:")
-        for command, description in commands.items():
+        for command, (_, description, _) in commands.handlers.items():
             print(f"{command}: {'-' * (max_length - len(command))}----  {description}")
 
+    # Show how often each command ran and how long it took, or turn collecting that on and off
+    @commands.register('stats', 'Show command timings; stats on|off|reset, stats dump file, stats export file [seconds]|off', reads=True)
+    def stats_command(self, line):
+        args = line.split()[1:]
+        stats = self.stats
+        if not args:
+            report = stats.as_dict()
+            if not stats.enabled:
+                print("Stats are off. Type 'stats on' to start collecting them.")
+            if not report['commands']:
+                return
+            print(f"{'command':<12} {'calls':>7} {'errors':>6} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+            for name, entry in report['commands'].items():
+                print(f"{name:<12} {entry['calls']:>7} {entry['errors']:>6} {entry['mean_ms']:>9.3f} "
+                      f"{entry['p50_ms']:>9.3f} {entry['p99_ms']:>9.3f} {entry['max_ms']:>9.3f}")
+            for counter, value in sorted(report['counters'].items()):
+                print(f"{counter}: {value}")
+            print(f"Collected over {report['seconds']:.1f} s")
+        elif args == ['on'] or args == ['off']:
+            stats.enabled = args[0] == 'on'
+            print(f"Stats are {args[0]}.")
+        elif args == ['reset']:
+            stats.reset()
+            print("Stats reset.")
+        elif args[0] == 'dump' and len(args) == 2:
+            try:
+                stats.dump(args[1])
+                print(f"Stats written to '{args[1]}'.")
+            except OSError as error:
+                self.error(f"Could not write '{args[1]}': {error}")
+        elif args == ['export', 'off']:
+            stats.export_path = None
+            print("Stats export stopped.")
+        elif args[0] == 'export' and len(args) in (2, 3):
+            try:
+                interval = float(args[2]) if len(args) == 3 else 60
+            except ValueError:
+                interval = 0
+            if interval <= 0:
+                self.error("The export interval must be a positive number of seconds.")
+                return
+            stats.export_path, stats.export_interval, stats.exported_at = args[1], interval, 0
+            print(f"Stats will be written to '{args[1]}' every {interval:g} s while they are on.")
+        else:
+            self.error("Invalid syntax. Usage: stats [on|off|reset|dump file|export file [seconds]|export off]")
+
+    @commands.register('whoami', "Show the current user and address", reads=True)
     def whoami_command(self):
         import socket
         ipv4_address = socket.gethostbyname(socket.gethostname())
         print(f"You are {self.user} at {ipv4_address}")
     
+    # Print a file piece by piece, so a large edited file is never joined into one string just to show it
+    def print_file(self, file):
+        for chunk in file.chunks():
+            print(chunk, end='')
+        print()
+
+    @commands.register('cat', 'Create, view, edit or override a file', reads=lambda line: line.split()[-1] == '-v')
     def cat_command(self, line):
         file_name = ""  # Get the file name from the command
         for i in line[4:]:
@@ -307,109 +2882,333 @@ class Terminal:
             if existing_file:
                 if command in ['-v', '-e', '-o']:
                     if command == '-v':
-                        print(existing_file.text)
+                        self.print_file(existing_file)
                     elif command == '-e':
-                        import pyperclip
-                        pyperclip.copy(existing_file.text)
                         editor = Editor()
-                        print("Editor is now open. Type ':q' to exit.")
-                        print("Paste the contents of the file and edit it as needed.")
-                        while True:
-                            user_input = input()
-                            if ":q" in user_input:
-                                index = user_input.index(":q")
-                                editor.text += user_input[:index] + "\n"
-                            editor.text += user_input + "\n"
-                        existing_file.text = editor.text
+                        editor.edit_existing(existing_file.text)
+                        self.write_file(existing_file, editor.text)
                     elif command == '-o':
                         editor = Editor()
                         editor.open_editor()
-                        existing_file.text = editor.text
+                        self.write_file(existing_file, editor.text)
                 else:
                     print(f"File '{file_name}' already exists.")
                     while True:
-                        action = input("Enter '-v' to view, '-e' to edit, or '-o' to override: ")
+                        action = read_line("Enter '-v' to view, '-e' to edit, or '-o' to override: ")
                         if action == '-v':
-                            print(existing_file.text)
+                            self.print_file(existing_file)
                             break
                         elif action == '-e':
-                            import pyperclip
-                            pyperclip.copy(existing_file.text)
                             editor = Editor()
-                            print("Editor is now open. Type ':q' to exit.")
-                            print("Paste the contents of the file and edit it as needed.")
-                            while True:
-                                user_input = input()
-                                if ":q" in user_input:
-                                    index = user_input.index(":q")
-                                    editor.text += user_input[:index] + "\n"
-                                    break
-                                editor.text += user_input + "\n"
-                            existing_file.text = editor.text
+                            editor.edit_existing(existing_file.text)
+                            self.write_file(existing_file, editor.text)
                             break
                         elif action == '-o':
                             editor = Editor()
                             editor.open_editor()
-                            existing_file.text = editor.text
+                            self.write_file(existing_file, editor.text)
                             break
                         else:
                             print("Invalid option. Please try again.")
-            else:
+            elif command == '-v':
+                self.not_found(f"File '{file_name}' not found.", file_name, File)  # Viewing never creates a file
+            elif self.current_directory.get(file_name):
+                self.error(f"A folder with the name '{file_name}' already exists.")
+            elif self.valid_name(file_name):
                 editor = Editor()
                 editor.open_editor()
-                new_file = File(file_name, editor.text)  # Create a new file with the text from the editor
-                self.current_directory.add_to_folder(new_file)  # Add the file to the current directory
+                # Create a new file with the text from the editor in the current directory
+                self.create_file(self.current_directory, file_name, editor.text)
                 print(f"File '{file_name}' created successfully.")
         else:
-            print("Please provide a file name.")
+            self.error("Please provide a file name.")
 
-    def find_file(self, file_name):
-        for item in self.current_directory.contents:
-            if isinstance(item, File) and item.name == file_name:
-                return item
-        return None
+    # Find the file named in a versions, diff or checkout command, reporting it if there is none
+    def find_versioned_file(self, file_name):
+        file = self.find_file(file_name)
+        if file is None:
+            self.not_found(f"File '{file_name}' not found.", file_name, File)
+        return file
+
+    # Check that each argument is the number of a version of file that is still kept
+    def version_numbers(self, file, args):
+        first, current = (file.versions.first, file.versions.current) if file.versions else (1, 1)
+        if not all(arg.isdigit() and first <= int(arg) <= current for arg in args):
+            kept = f"{first} to {current}" if first != current else f"{current}"
+            self.error(f"'{file.name}' has versions {kept}.")
+            return None
+        return [int(arg) for arg in args]
+
+    def version_text(self, file, number):
+        return file.text if file.versions is None or number == file.versions.current else file.versions.text(number)
+
+    # List the versions of a file kept so far. Versions are kept in memory, from the first time the
+    # file is rewritten until the terminal closes.
+    @commands.register('versions', 'List the earlier versions of a file (versions file)', reads=True)
+    def versions_command(self, line):
+        args = line.split()
+        if len(args) != 2:
+            self.error("Invalid syntax. Usage: versions file")
+            return
+        file = self.find_versioned_file(args[1])
+        if file is None:
+            return
+        if file.versions is None:
+            print(f"'{file.name}' has not been changed since it was created.")
+            return
+        history = file.versions
+        for number, (saved_at, size, keyframe, delta) in enumerate(history.entries, history.first):
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(saved_at)) if saved_at else "before history"
+            stored = "in full" if keyframe is not None else f"as changes ({len(delta)} parts)"
+            mark = "  (current)" if number == history.current else ""
+            print(f"{number:>5}  {when:<19}  {size:>10} bytes  stored {stored}{mark}")
+
+    # Show how two versions of a file differ: the previous and current ones, a version and the current
+    # one, or any two versions
+    @commands.register('diff', 'Show the changes between two versions of a file (diff file [version [version]])', reads=True)
+    def diff_command(self, line):
+        args = line.split()
+        if not 2 <= len(args) <= 4:
+            self.error("Invalid syntax. Usage: diff file [version [version]]")
+            return
+        file = self.find_versioned_file(args[1])
+        if file is None:
+            return
+        numbers = self.version_numbers(file, args[2:])
+        if numbers is None:
+            return
+        current = file.versions.current if file.versions else 1
+        if not numbers:
+            numbers = [max(current - 1, 1)]
+        if len(numbers) == 1:
+            numbers.append(current)
+        old, new = (self.version_text(file, number) for number in numbers)
+        lines = difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True),
+                                     f"{file.name}@{numbers[0]}", f"{file.name}@{numbers[1]}")
+        changed = False
+        for diff_line in lines:
+            print(diff_line if diff_line.endswith('\n') else diff_line + '\n', end='')
+            changed = True
+        if not changed:
+            print(f"Versions {numbers[0]} and {numbers[1]} of '{file.name}' are the same.")
+
+    # Put an earlier version of a file back. The file gets it as a new version, so the checkout can
+    # itself be undone or diffed.
+    @commands.register('checkout', 'Restore an earlier version of a file (checkout file version)')
+    def checkout_command(self, line):
+        args = line.split()
+        if len(args) != 3:
+            self.error("Invalid syntax. Usage: checkout file version")
+            return
+        file = self.find_versioned_file(args[1])
+        if file is None:
+            return
+        numbers = self.version_numbers(file, args[2:])
+        if numbers is None:
+            return
+        if file.versions is None or numbers[0] == file.versions.current:
+            print(f"'{file.name}' is already at version {numbers[0]}.")
+            return
+        self.write_file(file, self.version_text(file, numbers[0]))
+        print(f"Restored version {numbers[0]} of '{file.name}' as version {file.versions.current}.")
 
+    @commands.register('cd', 'Change the current directory (a name, or a path such as a/b, ../c or /a)', reads=True)
+    # Change to a folder given by name or by path. A path is absolute if it starts with '/' or 'root/',
+    # can use '.' and '..', and is looked up one name at a time in each folder's own index, so going
+    # several levels deep costs one dictionary lookup per level.
     def cd_command(self, line):
         directory_to_switch = line[3:]
         if directory_to_switch == "..":
             if self.current_directory.name == "root":
-                print("You are currently in the root directory and you cannot go back")
+                self.error("You are currently in the root directory and you cannot go back")
             else:
                 self.current_directory = self.current_directory.parent_directory
                 return
         else:
-            for content in self.current_directory.contents:
-                if isinstance(content, Folder) and content.name == directory_to_switch:
-                    content.parent_directory = self.current_directory
-                    self.current_directory = content
-                    return
-            print(f"Directory '{directory_to_switch}' not found.")
+            if "/" in directory_to_switch or directory_to_switch == ".":
+                content = self.lookup_path(self.full_path(directory_to_switch))
+            else:
+                content = self.current_directory.get(directory_to_switch)
+            if isinstance(content, Folder):
+                self.current_directory = content
+                self.touch(content)
+                return
+            name = directory_to_switch.rstrip("/").split("/")[-1]
+            self.not_found(f"Directory '{directory_to_switch}' not found.", name, Folder)
     
-    def suggest_similar_names(self, old_name):
-        similar_names = difflib.get_close_matches(old_name, [content.name for content in self.current_directory.contents], n=1, cutoff=0.5)
-        return similar_names
-        
+    # Return the paths of up to n items in the tree whose names look like name, optionally only
+    # items of one kind or inside one folder. The closest names come first, and for each name the
+    # paths under the current directory come before the rest.
+    def suggest_similar_paths(self, name, kind=None, inside=None, n=3):
+        here = path_of(self.current_directory).rstrip("/") + "/"
+        paths = []
+        for similar_name in self.index.similar.suggest(name, n=3 * n):
+            matches = [path_of(item) for item in self.index.lookup_name(similar_name, inside or self.root_directory)
+                       if kind is None or isinstance(item, kind)]
+            matches.sort(key=lambda path: (not path.startswith(here), path.count("/"), path))
+            paths.extend(matches)
+            if len(paths) >= n:
+                break
+        return paths[:n]
+
+    # Report something that could not be found, along with the closest names anywhere in the tree
+    def not_found(self, message, name, kind=None, inside=None):
+        similar_paths = self.suggest_similar_paths(name, kind, inside)
+        if similar_paths:
+            message += f" Did you mean: {', '.join(similar_paths)}"
+        self.error(message)
+
+    @commands.register('rname', 'Rename a file or folder')
     def rname_command(self, line):
         parts = line.split()
         if len(parts) != 3:
-            print("Invalid syntax. Usage: rname old_name new_name")
+            self.error("Invalid syntax. Usage: rname old_name new_name")
             return
         _, old_name, new_name = parts
-        for content in self.current_directory.contents:
-            if content.name == new_name:
-                print(f"A file or folder with the name '{new_name}' already exists.")
-                return
-            elif content.name == old_name:
-                content.name = new_name
-                print(f"Successfully renamed '{old_name}' to '{new_name}'.")
-                return
-        similar_names = self.suggest_similar_names(old_name)
-        if similar_names:
-            print(f"No such file or folder '{old_name}'. Did you mean: {similar_names[0]}")
-        else:
-            print(f"No such file or folder '{old_name}'.")
+        if not self.valid_name(new_name):
+            return
+        if self.current_directory.get(new_name):
+            self.error(f"A file or folder with the name '{new_name}' already exists.")
+            return
+        content = self.current_directory.get(old_name)
+        if content:
+            self.move_item(self.current_directory, content, self.current_directory, new_name)
+            print(f"Successfully renamed '{old_name}' to '{new_name}'.")
+            return
+        self.not_found(f"No such file or folder '{old_name}'.", old_name)
     
+    # Find the file or folder named in a du or count command: the current directory if no name is
+    # given, otherwise an item in the current directory or a path
+    def find_argument(self, line):
+        args = line.split(maxsplit=1)
+        if len(args) == 1:
+            return self.current_directory
+        if "/" in args[1]:
+            return self.lookup_path(self.full_path(args[1]))
+        return self.current_directory.get(args[1])
+
+    @commands.register('du', 'Show the total size of a file or folder', reads=True)
+    def du_command(self, line):
+        item = self.find_argument(line)
+        if item is None:
+            self.error(f"'{line.split(maxsplit=1)[1]}' not found.")
+        elif isinstance(item, Folder):
+            print(f"{item.byte_size} bytes in {item.file_count} files under '{item.name}'")
+        else:
+            print(f"{item.size} bytes in '{item.name}'")
+
+    @commands.register('count', 'Count the files and folders inside a folder', reads=True)
+    def count_command(self, line):
+        item = self.find_argument(line)
+        if item is None:
+            self.error(f"'{line.split(maxsplit=1)[1]}' not found.")
+        elif isinstance(item, Folder):
+            print(f"'{item.name}' contains {item.file_count} files and {item.folder_count} folders")
+        else:
+            print(f"'{item.name}' is a file.")
+
+    # Read in every folder under folder and index the text of the files in them, so that all of the
+    # files in it are in the text index. This is the only place text is read for the index: loading a
+    # folder for cd or ls does not read it. Folders already fully indexed are skipped, and files stay
+    # indexed when their folder is dropped from memory again, so this only walks the parts of the tree
+    # no grep or search has been through.
+    def load_subtree(self, folder):
+        complete = self.text_index.complete
+        stack = [folder]
+        visited = []
+        nodes = 0
+        while stack:
+            folder = stack.pop()
+            if folder in complete:
+                continue
+            visited.append(folder)
+            contents = folder.contents
+            nodes += len(contents)
+            for content in contents:
+                if isinstance(content, Folder):
+                    stack.append(content)
+                elif not self.text_index.has(content):
+                    self.text_index.add(content)
+        with self.text_index.lock:
+            complete.update(visited)
+        if self.stats.enabled:
+            self.stats.add('nodes_visited', nodes + 1)
+
+    # Whether a file or folder is still in the tree. Grep and search check each file the text index
+    # gives them, in case it was taken out of the tree without being taken out of the index.
+    def in_tree(self, item):
+        while item.parent_directory is not None:
+            parent = item.parent_directory
+            if parent.is_loaded and parent._index.get(item.name) is not item:
+                return False
+            item = parent
+        return item is self.root_directory
+
+    # The files under the current directory that grep and search look at. The recycle bin is left
+    # out unless that is where the search starts.
+    def searchable(self, files):
+        in_recycle_bin = self.is_inside(self.current_directory, self.recycle_bin)
+        results = []
+        for file in files:
+            if not self.in_tree(file):
+                self.text_index.remove(file)
+            elif (self.is_inside(file.parent_directory, self.current_directory)
+                  and (in_recycle_bin or not self.is_inside(file, self.recycle_bin))):
+                results.append((path_of(file), file))
+        return sorted(results)
+
+    # Find lines in the files under the current directory. The pattern is plain text unless -e makes it
+    # a regular expression, and -i ignores case. Only the files containing every trigram of the text,
+    # or of the text any match of the expression must contain, are read.
+    @commands.register('grep', 'Find lines in the files under the current directory (-e regex, -i ignore case)', reads=True)
+    def grep_command(self, line):
+        words = line.split(maxsplit=1)
+        pattern = words[1] if len(words) > 1 else ''
+        flags = set()
+        while pattern[:3] in ('-e ', '-i '):
+            flags.add(pattern[:2])
+            pattern = pattern[3:].lstrip()
+        if not pattern:
+            self.error("Invalid syntax. Usage: grep [-e] [-i] pattern")
+            return
+        try:
+            expression = re.compile(pattern if '-e' in flags else re.escape(pattern), re.IGNORECASE if '-i' in flags else 0)
+        except re.error as error:
+            self.error(f"Invalid regular expression: {error}")
+            return
+        self.load_subtree(self.current_directory)
+        candidates = self.text_index.candidates(required_literals(pattern) if '-e' in flags else [pattern])
+        if candidates is None:  # Too short to narrow down, so every file has to be read
+            candidates = TextIndex.files_in(self.current_directory, read=True)
+        found = False
+        results = self.searchable(candidates)
+        if self.stats.enabled:
+            self.stats.add('files_scanned', len(results))
+        for path, file in results:
+            for number, text in enumerate(''.join(file.chunks()).splitlines(), 1):
+                if expression.search(text):
+                    print(f"{path}:{number}: {text}")
+                    found = True
+        if not found:
+            print("No matches found.")
+
+    # List the files under the current directory that contain all of the given words
+    @commands.register('search', 'List the files under the current directory containing all of the given words', reads=True)
+    def search_command(self, line):
+        words = TextIndex.WORD.findall(line.lower())[1:]
+        if not words:
+            self.error("Invalid syntax. Usage: search word [word ...]")
+            return
+        self.load_subtree(self.current_directory)
+        results = self.searchable(self.text_index.files_with_words(words))
+        for path, _ in results:
+            print(path)
+        if not results:
+            print("No matches found.")
+
+    @commands.register('ls', 'List the contents of the current directory', reads=True)
     def ls_command(self, line):
+        self.touch(self.current_directory)
         contents = [(content.name, "directory" if isinstance(content, Folder) else "file") for content in self.current_directory.contents]
         if len(contents) == 0:
             print("No files or directories present")
@@ -420,242 +3219,826 @@ class Terminal:
             for name, type in contents:
                 print(f"{name} {'-' * (max_length - len(name))}----  {type}")
 
-    def check_recycle_bin(self):
-        while self.running:
-            current_time = time.time()
-            for content, move_time in list(self.recycle_bin_contents.items()):
-                if current_time - move_time > 120:  # 120 seconds = 2 minutes
-                    self.recycle_bin.contents.remove(content)
-                    del self.recycle_bin_contents[content]
-            time.sleep(1)  # Check every second
+    # Find the items in folder named by the arguments of rm, mv, cp or restore. Each argument is a name
+    # or a glob pattern such as *.txt or report_?. An item whose name is exactly the argument wins over
+    # the pattern, so a folder named [x] can still be removed. Names are looked up directly, while the
+    # patterns are combined into one regular expression and matched in a single pass over the folder's
+    # index, so matching costs the same however many patterns there are. The recycle bin is never
+    # matched by a pattern. Returns the items, in the order of the folder if there were patterns, and
+    # the arguments that matched nothing.
+    def match_items(self, folder, names):
+        patterns = list(dict.fromkeys(name for name in names if is_pattern(name) and folder.get(name) is None))
+        items = {}
+        missing = []
+        for name in names:
+            if name not in patterns:
+                item = folder.get(name)
+                if item is None:
+                    missing.append(name)
+                else:
+                    items[item] = None
+        if patterns:
+            matcher = re.compile('|'.join(f"(?P<p{i}>{fnmatch.translate(pattern)})" for i, pattern in enumerate(patterns)))
+            named = items
+            items = {}
+            used = set()
+            for item in folder.contents:
+                match = matcher.match(item.name)
+                if match and item is not self.recycle_bin:
+                    used.add(match.lastgroup)
+                    items[item] = None
+                elif item in named:
+                    items[item] = None
+            # A pattern whose matches were all claimed by an earlier one still matched something
+            missing += [pattern for i, pattern in enumerate(patterns) if f"p{i}" not in used
+                        and not any(fnmatch.fnmatchcase(item.name, pattern) for item in items)]
+        if self.stats.enabled and patterns:
+            self.stats.add('nodes_visited', len(folder.index))
+        return list(items), missing
+
+    # Report the arguments that matched nothing, suggesting similar names when there is only one
+    # argument. A single pattern gets suggestions too, since it may be a name with a typo in it.
+    def report_missing(self, missing, message, inside=None):
+        if len(missing) == 1:
+            message = f"Nothing matches {missing[0]!r}." if is_pattern(missing[0]) else message.format(missing[0])
+            self.not_found(message, missing[0], inside=inside)
+        else:
+            self.error(f"Nothing matches {', '.join(repr(name) for name in missing)}.")
 
+    @commands.register('rm', 'Move items to the recycle bin, or delete them from there (rm name|pattern ... [-y], -y skips the question)')
     def rm_command(self, line):
-        _, object_to_delete = line.split()
-        if object_to_delete == "recycle_bin":
-            print("Cannot delete the recycle bin")
+        args = line.split()[1:]
+        confirmed = '-y' in args  # Skip the question, for scripts
+        args = [arg for arg in args if arg != '-y']
+        if not args:
+            self.error("Invalid syntax. Usage: rm name|pattern ... [-y]")
+            return
+        if "recycle_bin" in args:
+            self.error("Cannot delete the recycle bin")
             return 
-        for content in self.current_directory.contents:
-            if content.name == object_to_delete:
-                if self.current_directory == self.recycle_bin:  # Check if we're currently in the recycle bin
-                    prompt = f"Are you sure you want to delete '{object_to_delete}'? This will permanently delete it. (y/n): "
-                else:
-                    prompt = f"Are you sure you want to delete '{object_to_delete}'? This will move the file to the recycle bin. (y/n): "
-                
-                response = input(prompt)
-                if response.lower() == 'y':
-                    if content in self.current_directory.contents:
-                        self.current_directory.contents.remove(content)
-                    if self.current_directory != self.recycle_bin:  # Only move to recycle bin if we're not already in it
-                        self.recycle_bin.add_to_folder(content)
-                        self.recycle_bin_contents[content] = time.time()
-                        print(f"'{object_to_delete}' has been moved to the recycle bin.")
-                    else:
-                        if content in self.recycle_bin_contents:
-                            del self.recycle_bin_contents[content]
-                        print(f"'{object_to_delete}' has been permanently deleted.")
-                elif response.lower() == 'n':
-                    print("Deletion cancelled.")
-                else:
-                    print("Invalid response. Deletion cancelled.")
-                return
-        print(f"The file '{object_to_delete}' does not exist.")
-            
-    def cp_command(self, line):
-        _, object_to_copy, destination = line.split()
-        location = None
-        # Search for the object to copy in the current directory
-        for content in self.current_directory.contents:
-            if content.name == object_to_copy:
-                location = content
-                break
-
-        if location:
-            # Search for the destination folder in the entire root directory
-            destination_folder = self.find_object(self.root_directory, destination)
+        items, missing = self.match_items(self.current_directory, args)
+        if missing:
+            self.report_missing(missing, "The file '{}' does not exist.")
+            return
+        in_recycle_bin = self.current_directory == self.recycle_bin  # Check if we're currently in the recycle bin
+        if len(items) == 1:
+            target = f"'{items[0].name}'"
+        else:
+            target = f"{len(items)} items"
+        if in_recycle_bin:
+            prompt = f"Are you sure you want to delete {target}? This will permanently delete {'it' if len(items) == 1 else 'them'}. (y/n): "
+        else:
+            prompt = f"Are you sure you want to delete {target}? This will move {'the file' if len(items) == 1 else 'them'} to the recycle bin. (y/n): "
 
-            if destination_folder and isinstance(destination_folder, Folder):
-                destination_folder.add_to_folder(location)
+        response = 'y' if confirmed else read_line(prompt)
+        if response.lower() == 'y':
+            if in_recycle_bin:
+                for item in items:
+                    self.delete_item(self.current_directory, item)
+                print(f"{target} {'has' if len(items) == 1 else 'have'} been permanently deleted.")
+                return
+            renamed = []
+            for item in items:  # Only move to recycle bin if we're not already in it
+                name = item.name
+                if self.recycle_item(self.current_directory, item):
+                    renamed.append((name, item.name))
+            if len(items) == 1:
+                if renamed:
+                    print(f"A file or folder with the name '{renamed[0][0]}' already exists in the recycle bin. Renamed it to '{renamed[0][1]}'.")
+                print(f"{target} has been moved to the recycle bin.")
             else:
-                print(f"Destination '{destination}' not found.")
+                note = f" ({len(renamed)} renamed, since the recycle bin already held their names)" if renamed else ""
+                print(f"{target} have been moved to the recycle bin{note}.")
+        elif response.lower() == 'n':
+            print("Deletion cancelled.")
         else:
-            print(f"'{object_to_copy}' not found.")
-    
-    def mv_command(self, line):
-        _, object_to_move, destination = line.split()
-        location = None
-        # Search for the object to move in the current directory
-        for content in self.current_directory.contents:
-            if content.name == object_to_move:
-                location = content
-                break
+            print("Invalid response. Deletion cancelled.")
 
-        if location:
-            # Search for the destination folder in the entire root directory
-            destination_folder = self.find_object(self.root_directory, destination)
+    # Find the items and the destination folder of a cp or mv command, and check that they can all be
+    # copied or moved there, so that either the whole batch goes through or none of it does.
+    # Returns None if they cannot.
+    def transfer_targets(self, line, verb):
+        args = line.split()[1:]
+        if len(args) < 2:
+            self.error(f"Invalid syntax. Usage: {line.split()[0]} name|pattern ... destination")
+            return None
+        *names, destination = args
+        items, missing = self.match_items(self.current_directory, names)
+        if missing:
+            self.report_missing(missing, "'{}' not found.")
+            return None
+        # Search for the destination folder in the entire root directory
+        destination_folder = self.find_object(self.root_directory, destination)
+        if not destination_folder or not isinstance(destination_folder, Folder):
+            self.not_found(f"Destination '{destination}' not found.", destination.rstrip("/").split("/")[-1], Folder)
+            return None
+        for item in items:
+            if self.is_inside(destination_folder, item):
+                self.error(f"Cannot {verb} '{item.name}' into itself.")
+                return None
+            if destination_folder.get(item.name):
+                self.error(f"A file or folder with the name '{item.name}' already exists in '{destination}'.")
+                return None
+        return items, destination_folder, len(names) > 1 or len(items) != 1
 
-            if destination_folder and isinstance(destination_folder, Folder):
-                # Add the object to the destination folder
-                destination_folder.add_to_folder(location)
-                # Remove the object from its original location
-                self.current_directory.contents.remove(location)
-            else:
-                print(f"Destination '{destination}' not found.")
-        else:
-            print(f"'{object_to_move}' not found.")
+    @commands.register('cp', 'Copy items into another folder (cp name|pattern ... destination)')
+    def cp_command(self, line):
+        targets = self.transfer_targets(line, 'copy')
+        if targets is None:
+            return
+        items, destination_folder, several = targets
+        for item in items:
+            self.copy_item(item, destination_folder)
+        if several:
+            print(f"Copied {len(items)} items to '{path_of(destination_folder)}'.")
+    
+    @commands.register('mv', 'Move items into another folder (mv name|pattern ... destination)')
+    def mv_command(self, line):
+        targets = self.transfer_targets(line, 'move')
+        if targets is None:
+            return
+        items, destination_folder, several = targets
+        for item in items:
+            # Remove the object from its original location and add it to the destination folder
+            self.move_item(self.current_directory, item, destination_folder)
+        if several:
+            print(f"Moved {len(items)} items to '{path_of(destination_folder)}'.")
 
-    # Helper function to find an object in a folder and its subdirectories
+    # Helper function to find an object in a folder and its subdirectories.
+    # The object can be given by name, or by a path such as '/docs/notes' or 'docs/notes'
+    # (a path that does not start with '/' is relative to the current directory)
     def find_object(self, folder, object_name):
-        for content in folder.contents:
-            if content.name == object_name:
+        if "/" in object_name:
+            return self.lookup_path(self.full_path(object_name))
+        content = folder.get(object_name)
+        if content:
+            return content
+        matches = self.index.lookup_name(object_name, folder)
+        if self.stats.enabled:
+            self.stats.add('nodes_visited', len(matches))
+        # Prefer a folder over a file with the same name, since this is used to find destinations
+        for content in matches:
+            if isinstance(content, Folder):
                 return content
-            elif isinstance(content, Folder):
-                result = self.find_object(content, object_name)
-                if result:
-                    return result
-        return None
+        return matches[0] if matches else None
+
+    # Check whether a folder is the given item or lies somewhere inside it
+    def is_inside(self, folder, item):
+        while folder is not None:
+            if folder is item:
+                return True
+            folder = folder.parent_directory
+        return False
+
+    # Turn a path typed by the user into a full path starting at the root.
+    # '.' stays in the same folder and '..' goes up one, but never above the root.
+    def full_path(self, path):
+        if path.startswith("root/") or path == "root":
+            path = path[4:]
+        elif not path.startswith("/"):
+            path = join_path(path_of(self.current_directory), path)
+        parts = []
+        for part in path.split("/"):
+            if part == "..":
+                if parts:
+                    parts.pop()
+            elif part and part != ".":
+                parts.append(part)
+        return "/" + "/".join(parts)
     
-    def empty_command(self):
+    @commands.register('empty', 'Empty the current directory or the recycle bin (-y skips the question)')
+    def empty_command(self, line):
+        confirmed = '-y' in line.split()[1:]  # Skip the question, for scripts
         if self.current_directory.name == "recycle_bin":
-            confirm = input("Are you sure you want to permanently deleted ALL files and folders? (y/n): ")
+            confirm = 'y' if confirmed else read_line("Are you sure you want to permanently deleted ALL files and folders? (y/n): ")
             if confirm.lower() == "y":
-                self.recycle_bin.contents = []
+                self.empty_recycle_bin()
                 print("All files and folders in the recycle bin have been deleted")
             else:
                 print("Nothing has been deleted")
         else:
-            confirm = input("Are you sure you want to move ALL files and folders into the recycle bin? (y/n): ")
+            confirm = 'y' if confirmed else read_line("Are you sure you want to move ALL files and folders into the recycle bin? (y/n): ")
             if confirm.lower() == "y":
-                for content in self.current_directory.contents[:]:
-                    # Check if a file or folder with the same name already exists in the recycle bin
-                    existing_content = next((c for c in self.recycle_bin.contents if c.name == content.name), None)
-                    if existing_content:
-                        print(f"A file or folder with the name '{content.name}' already exists in the recycle bin. Renaming...")
-                        # You could implement a better renaming strategy here
-                        content.name += "_1"
-                    self.recycle_bin.add_to_folder(content)
-                    self.recycle_bin_contents[content] = time.time()
-                self.current_directory.contents = []
+                for content in list(self.current_directory.contents):
+                    if content is self.recycle_bin:  # The recycle bin itself always stays where it is
+                        continue
+                    name = content.name
+                    # Items whose name is already taken in the recycle bin are renamed
+                    if self.recycle_item(self.current_directory, content):
+                        print(f"A file or folder with the name '{name}' already exists in the recycle bin. Renamed it to '{content.name}'.")
                 print(f'All files and folders in {self.current_directory.name} have been moved to the recycle bin.')
             else:
                 print("Nothing has been deleted.")
         return
 
+    @commands.register('restore', 'Restore items from the recycle bin (restore name|pattern ...)')
     def restore_command(self, line):
         if self.current_directory != self.recycle_bin:
-            print("You can only restore files from the recycle bin.")
-            return
-        _, object_to_restore = line.split()
-        for content in self.recycle_bin.contents:
-            if content.name == object_to_restore:
-                parent_directory = content.parent_directory
-                self.recycle_bin.contents.remove(content)
-                parent_directory.add_to_folder(content)
-                print(f"'{object_to_restore}' has been restored to its original location.")
+            self.error("You can only restore files from the recycle bin.")
+            return
+        args = line.split()[1:]
+        if not args:
+            self.error("Invalid syntax. Usage: restore name|pattern ...")
+            return
+        items, missing = self.match_items(self.recycle_bin, args)
+        if missing:
+            self.report_missing(missing, "The file '{}' does not exist in the recycle bin.", inside=self.recycle_bin)
+            return
+        for item in items:
+            if self.restore_destination(item).get(item.name):
+                self.error(f"A file or folder with the name '{item.name}' already exists in its original location.")
                 return
-        print(f"The file '{object_to_restore}' does not exist in the recycle bin.")
-    
+        for item in items:
+            self.restore_item(item)
+        if len(items) == 1 and len(args) == 1:
+            print(f"'{items[0].name}' has been restored to its original location.")
+        else:
+            print(f"{len(items)} items have been restored to their original locations.")
+
+
+    # Keep the tree as it is now under a name, so that undo can go back to it
+    @commands.register('snapshot', 'Save the tree so undo can return to it (snapshot [name]), or list the undo history (-l)', tracked=False)
+    def snapshot_command(self, line):
+        owner = self.tree_owner
+        name = line[len('snapshot'):].strip()
+        if name == '-l':
+            if not owner.history and not owner.future:
+                print("There is nothing to undo or redo.")
+            for steps, step in enumerate(reversed(owner.history), 1):
+                print(f"undo {steps}: before '{step.label}' ({time.time() - step.taken_at:.0f} s ago)")
+            for steps, step in enumerate(reversed(owner.future), 1):
+                print(f"redo {steps}: '{step.label}'")
+            return
+        owner.remember(UndoStep(f"snapshot {name}".strip()))
+        print(f"Snapshot {f'{name!r} ' if name else ''}saved. Type 'undo' to come back to it.")
+
+    # Read how many steps to undo or redo from the command line, or report why it cannot be done
+    def history_steps(self, line, steps, command):
+        args = line.split()[1:]
+        if len(args) > 1 or (args and (not args[0].isdigit() or int(args[0]) == 0)):
+            self.error(f"Invalid syntax. Usage: {command} [number of steps]")
+            return None
+        count = int(args[0]) if args else 1
+        if not steps:
+            self.error(f"There is nothing to {command}.")
+            return None
+        if count > len(steps):
+            self.error(f"There {'is' if len(steps) == 1 else 'are'} only {len(steps)} step{'s' if len(steps) != 1 else ''} to {command}.")
+            return None
+        return count
+
+    # Put the tree back the way it was before the last change, or the last few
+    @commands.register('undo', 'Undo the last change to the tree (undo [steps])', tracked=False)
+    def undo_command(self, line):
+        owner = self.tree_owner
+        steps = self.history_steps(line, owner.history, 'undo')
+        if steps is None:
+            return
+        for _ in range(steps):
+            step = owner.history.pop()
+            owner.history_changes -= len(step.changes)
+            owner.undo_step(step)
+            owner.future.append(step)
+            print(f"Undid '{step.label}'.")
+        owner.find_working_directories()
+
+    # Make the changes undone last again
+    @commands.register('redo', 'Redo the last undone change (redo [steps])', tracked=False)
+    def redo_command(self, line):
+        owner = self.tree_owner
+        steps = self.history_steps(line, owner.future, 'redo')
+        if steps is None:
+            return
+        for _ in range(steps):
+            step = owner.future.pop()
+            owner.redo_step(step)
+            owner.history.append(step)
+            owner.history_changes += len(step.changes)
+            print(f"Redid '{step.label}'.")
+        owner.find_working_directories()
 
     def find_file(self, filename):
         return self.find_file_recursive(self.current_directory, filename)
 
     def find_file_recursive(self, directory, filename):
-        for content in directory.contents:
-            if isinstance(content, File) and content.name == filename:
+        content = directory.get(filename)
+        if isinstance(content, File):
+            return content
+        matches = self.index.lookup_name(filename, directory)
+        if self.stats.enabled:
+            self.stats.add('nodes_visited', len(matches))
+        for content in matches:
+            if isinstance(content, File):
                 return content
-            elif isinstance(content, Folder):
-                file = self.find_file_recursive(content, filename)
-                if file:
-                    return file
         return None
     
+    # Run the commands in a script. Without flags each line is echoed with a prompt as it runs.
+    # -b runs it as a batch: the whole script is read and checked before anything runs, the output is
+    # collected in memory and written out in large blocks, and the time spent in each command is
+    # reported at the end. -q is a batch whose output is thrown away, apart from errors.
+    # -e stops at the first command that fails.
+    @commands.register('bash', 'Run the commands in a .txt script (-b batch, -q quiet, -e stop on error)')
     def bash_command(self, line):
-        filename = line[5:].strip()  # Extract the filename from the command
+        args = line.split()[1:]
+        flags = {arg for arg in args if arg.startswith('-')}
+        filename = ' '.join(arg for arg in args if not arg.startswith('-'))  # Extract the filename from the command
         try:
             with open(filename + '.txt', 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if line:  # Ignore empty lines
-                        print(f"\033[1;30m@{self.user}\033[0m \033[1;34m[{self.line_number}]\033[0m \033[1;32m${self.current_directory.name}\033[0m:", line, end='\n', flush=True)  # Print the prompt with correct formatting and increment line number
-                        self.execute(line)
-                        self.line_number = self.line_number + 1
+                script = [(number, line.strip()) for number, line in enumerate(file, 1) if line.strip()]  # Ignore empty lines
         except FileNotFoundError:
-            print(f"File '{filename}.txt' not found.")
+            self.error(f"File '{filename}.txt' not found.")
+            return
+        stop_on_error = '-e' in flags
+        if '-b' in flags or '-q' in flags:
+            self.run_batch(filename, script, '-q' in flags, stop_on_error)
+            return
+        for number, line in script:
+            print(self.prompt(), line, end='\n', flush=True)  # Print the prompt with correct formatting and increment line number
+            self.execute(line)
+            self.line_number = self.line_number + 1
+            if self.ending is not None:  # The script logged out
+                return
+            if stop_on_error and self.failed:
+                self.error(f"Stopped at line {number} of '{filename}.txt'.")
+                return
+        self.failed = False  # The script ran to the end, even if some of its commands failed
 
+    def run_batch(self, filename, script, quiet, stop_on_error):
+        # Look up every command first, so a typo is reported before anything has run
+        batch = []
+        for number, line in script:
+            name = line.split(maxsplit=1)[0].lower()
+            if commands.lookup(name) is None:
+                self.error(f"Line {number}: unknown command '{name}'.")
+            else:
+                batch.append((number, line, name))
+        failures = len(script) - len(batch)
+        if failures and stop_on_error:
+            return
+        timings = {}  # Maps each command name to [number of runs, seconds spent]
+        output = io.StringIO()
+        stopped_at = None
+        started = time.perf_counter()
+        with redirect_output(output) as stdout:
+            try:
+                for number, line, name in batch:
+                    begin = time.perf_counter()
+                    self.execute(line)
+                    timing = timings.setdefault(name, [0, 0.0])
+                    timing[0] += 1
+                    timing[1] += time.perf_counter() - begin
+                    if self.ending is not None:  # The script logged out
+                        break
+                    if self.failed:
+                        failures += 1
+                        if quiet:
+                            stdout.write(f"Line {number}: {self.last_error}\n")
+                        if stop_on_error:
+                            stopped_at = number
+                            break
+                    if quiet or output.tell() > self.BATCH_BUFFER_SIZE:
+                        if not quiet:
+                            stdout.write(output.getvalue())
+                        output.seek(0)
+                        output.truncate()
+            finally:
+                if not quiet:
+                    stdout.write(output.getvalue())
+        elapsed = time.perf_counter() - started
+        if stopped_at is not None:
+            self.error(f"Stopped at line {stopped_at} of '{filename}.txt'.")
+        print(f"Ran {sum(runs for runs, _ in timings.values())} commands from '{filename}.txt' in {elapsed:.3f} s, {failures} failed.")
+        for name, (runs, seconds) in sorted(timings.items(), key=lambda timing: -timing[1][1]):
+            print(f"  {name}: {runs} runs, {seconds:.3f} s")
+        if stopped_at is None:
+            self.failed = False
 
     def execute(self, line):
-        if line.lower() == 'exit':
-            self.exit_command()
-            #sys.exit(0)
-        elif line.lower() == 'cls':
-            self.cls_command()
-        elif line.lower() == 'logout':
-            self.logout_command()
-        elif line.lower().startswith('mkdir'):
-            self.mkdir_command(line)
-        elif line.lower().startswith('tree'):
-            self.tree_command(line)
-        elif line.lower() == 'help':
-            self.help_command()
-        elif line.lower() == 'whoami':
-            self.whoami_command()   
-        elif line.lower().startswith('cat'):
-            self.cat_command(line)
-        elif line.lower().startswith('cd'):
-            self.cd_command(line)
-        elif line.lower().startswith('rname'):
-            self.rname_command(line)
-        elif line.lower() == 'ls':
-            self.ls_command(line)
-        elif line.lower().startswith('rm'):
-            self.rm_command(line)
-        elif line.lower().startswith('cp'):
-            self.cp_command(line)
-        elif line.lower().startswith('mv'):
-            self.mv_command(line)
-        elif line.lower() == 'empty':
-            self.empty_command()
-        elif line.lower().startswith('restore'):
-            self.restore_command(line)
-        elif line.lower().startswith('bash'):
-            self.bash_command(line)
-        else:
-            # Fuzzy matching
-            available_commands = ['exit', 'cls', 'logout', 'mkdir', 'tree', 'help', 'whoami', 'cat']
-            close_matches = difflib.get_close_matches(line.lower(), available_commands, n=1, cutoff=0.5)
-            if close_matches:
-                print(f"Invalid command. Did you mean '{close_matches[0]}'? Type 'help' for a list of available commands.")
+        # Commands that only look at the tree run alongside each other. Commands that change it run
+        # one at a time with nothing else running, as does the recycle bin when it removes expired items.
+        started = time.perf_counter() if self.stats.enabled else None
+        reads = commands.reads_only(line)
+        with self.lock.read() if reads else self.lock.write():
+            owner = self.tree_owner
+            # A script is a single step to undo, so only the outermost command records its changes
+            outermost = self.depth == 0
+            step = UndoStep(line.strip()) if outermost and not reads and commands.tracked(line) else None
+            if step is not None:
+                owner.recording = step
+            self.depth += 1
+            try:
+                result = self.run_command(line)
+            finally:
+                self.depth -= 1
+                if step is not None:
+                    owner.recording = None
+            if step is not None and step.changes:
+                owner.remember(step)
+        if self.ending is not None:
+            if not outermost:
+                return False
+            self.close()
+            if self.ending == 'exit':
+                os._exit(0)
+            return False
+        if result != False and self.needs_tidy_up():
+            with self.lock.write():
+                self.tidy_up()
+        if started is not None:
+            words = line.split(maxsplit=1)
+            name = words[0].lower() if words and commands.lookup(words[0]) else "(invalid)"
+            self.stats.record(name, time.perf_counter() - started, self.failed)
+            self.stats.export_if_due()
+        return result
+
+    def run_command(self, line):
+        self.failed = False
+        words = line.split(maxsplit=1)  # The command name and the rest of the line
+        if words:
+            entry = commands.lookup(words[0])
+            if entry is not None:
+                method, _, takes_line = entry
+                handler = getattr(self, method)
+                if (handler(line) if takes_line else handler()) == False:
+                    return False  # Logging out
             else:
-                print("Invalid command. Type 'help' for a list of available commands.")
+                close_matches = commands.suggestions.suggest(words[0])
+                if close_matches:
+                    self.error(f"Invalid command. Did you mean '{close_matches[0]}'? Type 'help' for a list of available commands.")
+                else:
+                    self.error("Invalid command. Type 'help' for a list of available commands.")
         #self.line_number += 1
 
+    # Whether a snapshot is due or the tree has grown past its memory budget
+    def needs_tidy_up(self):
+        if self.store is None:
+            return False
+        return self.store.needs_snapshot or (self.store.reader is not None and self.store.reader.over_budget)
+
+    # Save a snapshot once enough changes have built up, and drop folders to stay within the memory
+    # budget. Both change how the tree is stored, so they need the write lock.
+    def tidy_up(self):
+        if self.store is not None and self.store.needs_snapshot:
+            self.store.save_snapshot(self)
+        self.evict_unused_folders()
+
     def run(self):
         while True:
             line = self.get_line()
             if self.execute(line) == False:  # Check if execute returns False
                 return  # Exit the run method
 
-def get_password(prompt):
-    print(prompt, end='', flush=True)
-    password = ''
-    while True:
-        char = msvcrt.getch()
-        if char == b'\r':  # Enter key
-            break
-        elif char == b'\x08':  # Backspace
-            if password:
-                password = password[:-1]
-                sys.stdout.write('\b \b')  # Remove last character
+class TerminalSession(Terminal):
+    # A session on a tree that another Terminal owns, used for each network connection. It has its own
+    # current directory, line number and error state, and reads everything else, including the tree,
+    # the lock and the store, from the owner.
+    def __init__(self, owner):
+        self.owner = owner
+        self.closed = False  # Set when the session logs out
+        self.user = owner.user
+        self.line_number = 1
+        self.current_directory = owner.root_directory
+        self.failed = False
+        self.last_error = None
+        self.depth = 0
+        self.ending = None
+        owner.sessions.add(self)
+
+    def __getattr__(self, name):
+        return getattr(self.owner, name)
+
+    @property
+    def tree_owner(self):
+        return self.owner
+
+    def run_command(self, line):
+        # Another session may have removed the folder this one was in
+        if self.lookup_path(path_of(self.current_directory)) is not self.current_directory:
+            print("Your current directory was removed by another session. Moved back to root.")
+            self.current_directory = self.root_directory
+        return super().run_command(line)
+
+    # Logging out of a session only ends the session. The server closes the tree once the last
+    # session on it has gone, outside the tree's lock.
+    def close(self):
+        self.closed = True
+
+    def exit_command(self):
+        return self.logout_command()  # Exiting a network session must not stop the server
+
+    def cls_command(self):
+        print('\033[2J\033[H', end='')  # Clear the client's screen, not the server's
+
+
+class ConnectionStream:
+    # The console of one network session. Output is collected until it is flushed and then handed
+    # to the event loop to send. Lines from the client wait in a queue, like typed-ahead input on a
+    # terminal: each one is either the next command or, if a command is asking a question, its answer.
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.output = []
+        self.lines = deque()
+        self.condition = threading.Condition()
+        self.ended = False  # Set when the client has gone, so nothing more will be read
+
+    def write(self, text):
+        self.output.append(text)
+        return len(text)
+
+    def flush(self):
+        if self.output:
+            data = ''.join(self.output).encode()
+            self.output = []
+            self.loop.call_soon_threadsafe(self.send, data)
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def put(self, line):
+        with self.condition:
+            self.lines.append(line)
+            self.condition.notify()
+
+    # Return the next line if there is one, without waiting
+    def take(self):
+        with self.condition:
+            return self.lines.popleft() if self.lines else None
+
+    def end(self):
+        with self.condition:
+            self.ended = True
+            self.condition.notify()
+
+    # Called by input() on a worker thread: wait for the client's answer. '' means the client left.
+    def readline(self):
+        self.flush()
+        with self.condition:
+            while not self.lines and not self.ended:
+                self.condition.wait()
+            return self.lines.popleft() + '\n' if self.lines else ''
+
+
+class TerminalServer:
+    # Serves terminal sessions over TCP. Each connection is a coroutine waiting on its socket, so an
+    # idle connection costs no thread; commands run on a small pool of worker threads. Every connection
+    # gets its own session, and all the sessions of one user share that user's tree, which is loaded
+    # when the first of them logs in and saved when the last one leaves.
+    def __init__(self, login_system, host='127.0.0.1', port=2323, workers=None, storage_directory='filesystems'):
+        self.login_system = login_system
+        self.host = host
+        self.port = port
+        self.storage_directory = storage_directory
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4), thread_name_prefix="session")
+        self.trees = {}  # Maps each username to [the Terminal owning their tree, number of open sessions]
+        self.trees_lock = threading.Lock()
+        # Commands print and read through these, and each worker thread points them at its own connection
+        if not isinstance(sys.stdout, ThreadLocalStream):
+            sys.stdout = ThreadLocalStream(sys.stdout)
+        if not isinstance(sys.stdin, ThreadLocalStream):
+            sys.stdin = ThreadLocalStream(sys.stdin)
+
+    def open_session(self, username):
+        with self.trees_lock:
+            tree = self.trees.get(username)
+            if tree is None:
+                tree = self.trees[username] = [Terminal(username, self.storage_directory), 0]
+            tree[1] += 1
+            return TerminalSession(tree[0])
+
+    def close_session(self, session):
+        with self.trees_lock:
+            tree = self.trees[session.user]
+            tree[1] -= 1
+            if tree[1] == 0:
+                del self.trees[session.user]
+                tree[0].close()
+
+    # Run one line of a session on a worker thread, with its output going to the connection
+    def run_line(self, session, stream, line):
+        with sys.stdout.redirect(stream), sys.stdin.redirect(stream):
+            try:
+                result = session.execute(line)
+            except EOFError:  # The client left while a command was asking a question
+                result = False
+            except Exception as error:
+                print(f"Error: {error}")
+                result = None
+            session.line_number += 1
+            stream.flush()
+        return result
+
+    async def ask(self, reader, writer, prompt):
+        writer.write(prompt.encode())
+        line = await reader.readline()
+        return line.decode(errors='replace').strip() if line else None
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        stream = ConnectionStream(loop, writer)
+        session = None
+        read = running = None
+        try:
+            username = await self.ask(reader, writer, "Enter your username: ")
+            password = await self.ask(reader, writer, "Enter your password: ") if username else None
+            if password is None:
+                return
+            if not await asyncio.wrap_future(self.login_system.login_async(username, password)):
+                writer.write(b"Invalid username or password.\n")
+                return
+            session = await loop.run_in_executor(self.pool, self.open_session, username)
+            writer.write(f"Login successful!\n{session.prompt()} ".encode())
+            read = asyncio.ensure_future(reader.readline())
+            while True:
+                done, _ = await asyncio.wait({read} if running is None else {read, running}, return_when=asyncio.FIRST_COMPLETED)
+                if running in done:
+                    if running.result() == False:  # Logged out
+                        break
+                    running = None
+                    writer.write(f"{session.prompt()} ".encode())
+                if read in done:
+                    line = read.result()
+                    if not line:
+                        break
+                    stream.put(line.decode(errors='replace').strip())
+                    read = asyncio.ensure_future(reader.readline())
+                if running is None:
+                    line = stream.take()
+                    if line is not None:
+                        running = loop.run_in_executor(self.pool, self.run_line, session, stream, line)
+        except (ConnectionError, ValueError):  # ValueError when a line is longer than the stream limit
+            pass
+        finally:
+            if read is not None:
+                read.cancel()
+            if running is not None:
+                stream.end()
+                await asyncio.wait({running})
+            if session is not None:
+                await loop.run_in_executor(self.pool, self.close_session, session)
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Serving on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Save every tree that still has sessions on it
+            with self.trees_lock:
+                for terminal, _ in self.trees.values():
+                    terminal.close()
+                self.trees.clear()
+
+
+class Keyboard:
+    # Reads keys from the console in batches. read() waits for at least one key and then returns
+    # every key that is already waiting, so a pasted command comes back in one piece and can be drawn
+    # with one write instead of one per character. Enter always comes back as '\r' and backspace as
+    # '\b', whatever the platform sends for them.
+    def __init__(self):
+        self.pending = ''  # Keys read but not used yet
+
+    def read(self):
+        if self.pending:
+            keys, self.pending = self.pending, ''
+            return keys
+        return self.read_keys()
+
+    # Put keys back to be returned by the next read
+    def unread(self, keys):
+        self.pending = keys + self.pending
+
+    # Put the console into the mode this keyboard needs while a line is being read
+    @contextlib.contextmanager
+    def session(self):
+        yield
+
+    # Read one line, drawing each key as it is typed, or mask in its place if given. Keys after Enter
+    # are left for the next read.
+    def read_line(self, prompt='', mask=None):
+        print(prompt, end='', flush=True)
+        line = ''
+        with self.session():
+            while True:
+                keys = self.read()
+                echo = []
+                entered = False
+                for position, char in enumerate(keys):
+                    if char == '\r':  # Enter key
+                        self.unread(keys[position + 1:])
+                        entered = True
+                        break
+                    elif char == '\b':  # Backspace
+                        if line:
+                            line = line[:-1]
+                            echo.append('\b \b')  # Remove last character
+                    elif char.isprintable():
+                        line += char
+                        echo.append(mask or char)
+                sys.stdout.write(''.join(echo))
                 sys.stdout.flush()
+                if entered:
+                    break
+        print()  # Newline
+        return line
+
+
+class WindowsKeyboard(Keyboard):
+    def read_keys(self):
+        keys = [msvcrt.getwch()]
+        while msvcrt.kbhit():
+            keys.append(msvcrt.getwch())
+        return ''.join(keys)
+
+
+class PosixKeyboard(Keyboard):
+    # Reads from a terminal on Linux and macOS, with echo and line buffering turned off (cbreak mode)
+    # so every key arrives as soon as it is pressed. Ctrl+C still interrupts. Arrow keys and other
+    # escape sequences are dropped.
+    ESCAPE_SEQUENCE = re.compile(r'\x1b(\[[0-9;?]*[@-~]|O.|.)?')
+
+    def __init__(self, fd):
+        super().__init__()
+        self.fd = fd
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    @contextlib.contextmanager
+    def session(self):
+        attributes = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)
+        try:
+            yield
+        finally:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, attributes)
+
+    def read_keys(self):
+        keys = ''
+        while not keys:  # A read can end in the middle of a character
+            data = os.read(self.fd, 4096)  # Everything waiting, up to 4 KB
+            if not data:
+                raise EOFError
+            keys = self.ESCAPE_SEQUENCE.sub('', self.decoder.decode(data))
+        return keys.replace('\x7f', '\b').replace('\n', '\r')
+
+
+class LineKeyboard(Keyboard):
+    # Used when input is not a terminal, such as a pipe or a file: a whole line is one batch of keys
+    def read_keys(self):
+        line = sys.stdin.readline()
+        if not line:
+            raise EOFError
+        return line.rstrip('\r\n') + '\r'
+
+
+keyboard = None
+
+
+# Return the keyboard for this console, choosing the backend the first time
+def get_keyboard():
+    global keyboard
+    if keyboard is None:
+        if msvcrt is not None:
+            keyboard = WindowsKeyboard()
+        elif termios is not None and sys.stdin.isatty():
+            keyboard = PosixKeyboard(sys.stdin.fileno())
         else:
-            password += char.decode()
-            sys.stdout.write('*')
-            sys.stdout.flush()
-    print()  # Newline
-    return password
+            keyboard = LineKeyboard()
+    return keyboard
+
+
+def get_password(prompt):
+    return get_keyboard().read_line(prompt, mask='*')
+
+
+# Read a line answering a question, or typed into the editor. Once the console's keyboard has been
+# used, keys it read after an Enter (the answer to a question pasted together with the command, say)
+# are waiting in it rather than on the console, so the line is read through the keyboard to take
+# them first. Otherwise this is input(), which also reads from a network session's connection.
+def read_line(prompt=''):
+    if keyboard is None or not keyboard.pending:
+        return input(prompt)
+    return keyboard.read_line(prompt)
 
 def main():
+    parser = argparse.ArgumentParser(description="A terminal with its own virtual file system")
+    parser.add_argument('--serve', action='store_true', help="serve terminal sessions over TCP instead of the console")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2323)
+    parser.add_argument('--workers', type=int, help="threads running commands in server mode")
+    args = parser.parse_args()
     login_system = LoginSystem()
-    login_system.run()
+    if args.serve:
+        TerminalServer(login_system, args.host, args.port, args.workers).run()
+    else:
+        login_system.run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,184 @@
+# Check that a user's tree comes back unchanged from disk: from a snapshot, from the journal alone
+# after a crash, and from a journal whose last record was only partly written.
+#
+# Usage: python -m pytest tests, or python -m unittest discover tests
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from main import FileSystemStore, Folder, Terminal, path_of, redirect_output  # noqa: E402
+
+
+class FileSystemStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.terminals = []
+
+    def tearDown(self):
+        for terminal in self.terminals:
+            terminal.expiry.stop()
+            if terminal.store is not None:
+                terminal.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open(self):
+        with redirect_output(io.StringIO()):
+            terminal = Terminal("tester", self.directory)
+        self.terminals.append(terminal)
+        return terminal
+
+    # Close the tree the way logging out does, saving a snapshot
+    def close(self, terminal):
+        with redirect_output(io.StringIO()):
+            terminal.close()
+
+    # Stop writing to the disk without saving a snapshot, as if the program had been killed right after
+    # the journal was last written
+    def crash(self, terminal):
+        terminal.expiry.stop()
+        terminal.store.close()
+        terminal.store = None
+
+    # Make changes covering every journal operation
+    def change(self, terminal):
+        root = terminal.root_directory
+        now = time.time()  # Recycled items have to be recent, or they expire as soon as the tree is read back
+        docs = terminal.create_folder(root, "docs")
+        notes = terminal.create_folder(docs, "notes")
+        terminal.create_file(notes, "todo.txt", "buy milk\nfix bike\n")
+        terminal.create_file(docs, "naïve ünïcode.txt", "κείμενο ✓\n" * 50)
+        terminal.create_file(root, "empty.txt", "")
+        big = terminal.create_file(root, "big.txt", "line\n" * 20000)
+        terminal.write_file(big, big.text + "last line\n")
+        terminal.copy_item(notes, root)
+        terminal.move_item(root, root.get("empty.txt"), docs, "renamed.txt")
+        terminal.recycle_item(docs, notes, now - 2)
+        old = terminal.create_file(root, "old.txt", "gone")
+        terminal.recycle_item(root, old, now - 1)
+        terminal.restore_item(terminal.recycle_bin.get("old.txt"))
+        terminal.delete_item(root, root.get("old.txt"))
+
+    # Everything stored about the tree: each path with its text, and each recycled item with its
+    # deletion time and original folder
+    def describe(self, terminal):
+        items = []
+        stack = [terminal.root_directory]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, Folder):
+                items.append((path_of(item), None))
+                stack.extend(item.contents)
+            else:
+                items.append((path_of(item), item.text))
+        recycled = [(path_of(item), deleted_at, path_of(terminal.recycle_bin_origins[item]))
+                    for item, deleted_at in terminal.recycle_bin_contents.items()]
+        return sorted(items), sorted(recycled)
+
+    def test_snapshot_round_trip(self):
+        terminal = self.open()
+        self.change(terminal)
+        expected = self.describe(terminal)
+        self.close(terminal)
+        terminal = self.open()
+        self.assertEqual(self.describe(terminal), expected)
+        # A second round trip copies the folders that were never read straight from the first snapshot
+        terminal.create_file(terminal.root_directory, "more.txt", "more")
+        expected = self.describe(terminal)
+        self.close(terminal)
+        self.assertEqual(self.describe(self.open()), expected)
+
+    def test_crash_replay(self):
+        terminal = self.open()
+        terminal.create_folder(terminal.root_directory, "before")
+        terminal.store.save_snapshot(terminal)
+        self.change(terminal)
+        terminal.store.flush()
+        expected = self.describe(terminal)
+        journal_path = terminal.store.journal_path
+        self.crash(terminal)
+        self.assertGreater(os.path.getsize(journal_path), len(FileSystemStore.JOURNAL_MAGIC))
+        terminal = self.open()
+        self.assertEqual(self.describe(terminal), expected)
+        # Changes made after the replay go on from where the journal left off
+        terminal.create_folder(terminal.root_directory, "after")
+        terminal.store.flush()
+        expected = self.describe(terminal)
+        self.crash(terminal)
+        self.assertEqual(self.describe(self.open()), expected)
+
+    def test_torn_journal_tail(self):
+        terminal = self.open()
+        self.change(terminal)
+        terminal.store.flush()
+        expected = self.describe(terminal)
+        journal_path = terminal.store.journal_path
+        self.crash(terminal)
+        good_length = os.path.getsize(journal_path)
+        with open(journal_path, 'ab') as journal:
+            journal.write(b'\x0d\x00\x00\x00\x00\x00\x00\x00\x01\xff')  # The start of a record, cut off
+        terminal = self.open()
+        self.assertEqual(self.describe(terminal), expected)
+        self.assertEqual(os.path.getsize(journal_path), good_length)
+        terminal.create_file(terminal.root_directory, "new.txt", "written after the torn record")
+        terminal.store.flush()
+        expected = self.describe(terminal)
+        self.crash(terminal)
+        self.assertEqual(self.describe(self.open()), expected)
+
+    def test_record_that_cannot_be_applied_is_skipped(self):
+        terminal = self.open()
+        with redirect_output(io.StringIO()):
+            terminal.execute("mkdir a/b")
+        self.assertIsNone(terminal.root_directory.get("a/b"))
+        # A journal written before such names were refused still has to be readable
+        terminal.create_folder(terminal.root_directory, "a/b")
+        terminal.create_folder(terminal.root_directory, "kept")
+        terminal.store.flush()
+        self.crash(terminal)
+        output = io.StringIO()
+        with redirect_output(output):
+            terminal = Terminal("tester", self.directory)
+        self.terminals.append(terminal)
+        self.assertIn("Skipped", output.getvalue())
+        self.assertIsNotNone(terminal.root_directory.get("kept"))
+
+    def test_changed_folders_can_be_dropped_after_a_snapshot(self):
+        terminal = self.open()
+        self.change(terminal)
+        for number in range(20):
+            folder = terminal.create_folder(terminal.root_directory, f"folder {number}")
+            terminal.create_file(folder, "note.txt", f"note {number}")
+        expected = self.describe(terminal)
+        terminal.store.save_snapshot(terminal)
+        reader = terminal.store.reader
+        self.assertFalse(any(folder.dirty for folder in reader.loaded))
+        reader.node_budget = 10
+        terminal.evict_unused_folders()
+        # Only the current directory stays, and the recycle bin, whose items are kept by their objects
+        self.assertEqual(set(reader.loaded), {terminal.root_directory, terminal.recycle_bin})
+        self.assertEqual(self.describe(terminal), expected)
+        self.close(terminal)
+        self.assertEqual(self.describe(self.open()), expected)
+
+    def test_snapshot_is_replaced_by_a_new_generation(self):
+        terminal = self.open()
+        self.change(terminal)
+        terminal.store.save_snapshot(terminal)
+        terminal.create_folder(terminal.root_directory, "later")
+        expected = self.describe(terminal)
+        self.close(terminal)
+        generations, unfinished = FileSystemStore("tester", self.directory).find_snapshots()
+        self.assertEqual(len(generations), 1)
+        self.assertEqual(unfinished, [])
+        self.assertEqual(self.describe(self.open()), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
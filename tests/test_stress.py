@@ -0,0 +1,53 @@
+# A short run of benchmarks/stress.py: two writer and two reader sessions share one tree for a
+# second and a half, with the recycle bin expiring items underneath them, and the tree has to come
+# out consistent.
+#
+# Usage: python -m pytest tests, or python -m unittest discover tests
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.stress import check, reader, writer  # noqa: E402
+from main import Terminal, ThreadLocalStream  # noqa: E402
+
+
+class StressTest(unittest.TestCase):
+    SECONDS = 1.5
+    WRITERS = 2
+    READERS = 2
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = ThreadLocalStream(sys.stdout)  # Lets each session print to its own stream
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_concurrent_sessions_leave_a_consistent_tree(self):
+        terminal = Terminal("stress", None, recycle_bin_ttl=0.005)
+        stop = threading.Event()
+        errors = []
+        counter = [0] * self.READERS
+        threads = [threading.Thread(target=writer, args=(terminal, number, stop, errors)) for number in range(self.WRITERS)]
+        threads += [threading.Thread(target=reader, args=(terminal, number, stop, errors, counter))
+                    for number in range(self.READERS)]
+        for thread in threads:
+            thread.start()
+        time.sleep(self.SECONDS)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=30)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "a session did not finish")
+        terminal.close()
+        self.assertEqual(errors, [])
+        self.assertGreater(sum(counter), 0)
+        check(terminal)
+
+
+if __name__ == '__main__':
+    unittest.main()